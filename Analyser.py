@@ -1,163 +1,867 @@
 import os.path
+import threading
+import time
 
-import markdown
-from Bio import SeqIO
-import regex, re
-from Bio.Seq import Seq
-from collections import defaultdict
+from collections import namedtuple
+from collections.abc import Mapping
+from functools import cached_property
 import numpy as np
-import pandas as pd
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 import base64
 
-from Bio import pairwise2
-from matplotlib import pyplot as plt
+# pandas、matplotlib、Biopython、markdown 导入较慢，只在用到的函数里导入，
+# 这样界面和命令行启动时不用等它们加载
 
+from abif import ABIFReader
+from aligner import DEFAULT_ALIGNER, getAligner
+from cache import AnalysisCache, fileDigest
+from instrument import count, formatStages, peakMemory, recorder, stage, stageTable
+from manifest import ANALYSE, RENDER, SKIP
+from sheets import DEFAULT_FORMATS, writeSheet
+from qc import CHANNELS, DEFAULT_MIN_SNR, DEFAULT_TRIM_CUTOFF, mottTrim, noiseProfile
 
-class SangerBaseCall:
-    def __init__(self, sanger_file):
-        self.sanger_data = SeqIO.read(sanger_file, "abi")
-        self.sanger_seq = str(self.sanger_data.seq).upper()
-
-        self.labels = {}
-        signal_length = self.sanger_data.annotations["abif_raw"]["PLOC1"][-1]
-        base_locations = self.sanger_data.annotations["abif_raw"]["PLOC1"]
-        self.annotation = {}
-        self.location_base_annotation = {}
-
-        # 列出每个碱基位置上分别是什么碱基和他对应的测序峰值位置。
-        for i in range(len(self.sanger_seq)):
-            self.annotation[i] = [self.sanger_seq[i], base_locations[i]]
-            self.location_base_annotation[base_locations[i]] = self.sanger_seq[i]
-
-        # 列出每个信号列中的信号值
-        channels = {"G": "DATA9", "A": "DATA10", "T": "DATA11", "C": "DATA12"}  # GATC
-        self.trace = {}
-        for c in channels:
-            self.trace[c] = self.sanger_data.annotations["abif_raw"][channels[c]]
-
-        # 根据信号峰值填入碱基位置
-        for i in range(signal_length):
-            if i in base_locations:
-                self.labels[i] = self.location_base_annotation[i]
-            else:
-                self.labels[i] = ""
 
-        # 整体的噪音
-        self.noise = {"G": [], "A": [], "T": [], "C": []}
+__version__ = "1.0.1"
 
-    def locTartet(self, target_seq, max_mismatch=10):
-        # Find the match site and location
-        target_is_reversed = False
-        target_seq = str(target_seq).upper()
-        alignment_1 = pairwise2.align.localms(target_seq, self.sanger_seq, 2, -.1, -4, -2, one_alignment_only=True)
-        target_seq_reversed = str(Seq(target_seq).reverse_complement())
-        alignment_2 = pairwise2.align.localms(target_seq_reversed, self.sanger_seq, 2, -.1, -4, -2,
-                                              one_alignment_only=True)
-        try:
-            alignment_1[0]
-        except:
-            alignment_1 = [[0, 0, 0]]
+# DATA9-12 四个信号通道，依次对应 CHANNELS 中的碱基
+CHANNEL_TAGS = ("DATA9", "DATA10", "DATA11", "DATA12")
+
+
+class _BaseAnnotationView(Mapping):
+    """碱基序号 -> [碱基, 峰值位置]，按需从数组中取值"""
+
+    def __init__(self, call):
+        self._call = call
+
+    def __getitem__(self, i):
+        if not isinstance(i, (int, np.integer)) or not 0 <= i < len(self):
+            raise KeyError(i)
+        return [chr(self._call.base_calls[i]), int(self._call.base_locations[i])]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return len(self._call.base_calls)
+
+
+class _LocationBaseView(Mapping):
+    """峰值位置 -> 碱基"""
+
+    def __init__(self, call):
+        self._call = call
+
+    def __getitem__(self, loc):
+        i = self._call._baseIndex(loc)
+        if i < 0:
+            raise KeyError(loc)
+        return chr(self._call.base_calls[i])
+
+    def __iter__(self):
+        return iter(dict.fromkeys(self._call.base_locations.tolist()))
+
+    def __len__(self):
+        return len(np.unique(self._call.base_locations))
+
+
+class _LabelView(Mapping):
+    """信号采样点 -> 该处峰值对应的碱基，没有峰值的位置为空字符串"""
+
+    def __init__(self, call):
+        self._call = call
+
+    def __getitem__(self, i):
+        if not isinstance(i, (int, np.integer)) or not 0 <= i < len(self):
+            raise KeyError(i)
+        j = self._call._baseIndex(i)
+        return chr(self._call.base_calls[j]) if j >= 0 else ""
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return self._call.signal_length
+
+
+class SangerBaseCall:
+    def __init__(self, sanger_file, reader="abif", cache=None, aligner=DEFAULT_ALIGNER, trim_cutoff=DEFAULT_TRIM_CUTOFF):
+        """reader 为 "abif" 时只读取需要的标签；为 "biopython" 时沿用 SeqIO.read 全量解析。
+        传入 cache (AnalysisCache) 时按文件内容复用解析和比对结果。
+        aligner 为比对后端的名字或 Aligner 对象，"pairwise2" 为旧版实现。
+        trim_cutoff 为按 PCON 质量值做 Mott 修剪的错误率阈值，None 表示不修剪"""
+        self.sanger_file = sanger_file
+        self.aligner = getAligner(aligner)
+        self.cache = cache
+        self.digest = fileDigest(sanger_file) if cache is not None else None
+
+        arrays = cache.loadTrace(self.digest) if cache is not None else None
+        if arrays is None:
+            with stage("parse"):
+                self._parse(reader)
+            count("traces.parsed")
+            if cache is not None:
+                cache.saveTrace(self.digest, self.toArrays())
+        else:
+            count("traces.cached")
+            self.sanger_seq = arrays["sequence"].tobytes().decode("ascii")
+            self.base_locations = arrays["base_locations"]
+            self.base_calls = arrays["base_calls"]
+            self.qualities = arrays["qualities"]
+            self.traces = arrays["traces"]
+
+        self.signal_length = int(self.base_locations[-1]) if len(self.base_locations) else 0
+
+        with stage("qc"):
+            # 整体的噪音和信噪比，解析时就算好，用于在比对前剔除失败的测序
+            self.qc = noiseProfile(self.traces, self.base_locations, self.base_calls)
+            self.noise = self.qc.noise
+
+            # 两端质量差的碱基不参与比对，[trim_start, trim_end) 之外的部分只是不拿去比对，坐标不变。
+            # 没有质量值或者整条都不合格时比对全长
+            self.trim_cutoff = trim_cutoff
+            self.trim_start, self.trim_end = 0, len(self.sanger_seq)
+            if trim_cutoff is not None and len(self.qualities):
+                start, end = mottTrim(self.qualities, trim_cutoff)
+                if end > start:
+                    self.trim_start, self.trim_end = start, end
+
+    def _parse(self, reader):
+        if reader == "abif":
+            # 数组都复制出来，读完就关闭文件映射，不等垃圾回收
+            with ABIFReader(self.sanger_file) as abif_raw:
+                self._readTags(abif_raw, bytes(abif_raw.first("PBAS2", "PBAS1")).decode("ascii"),
+                               abif_raw.first("PLOC1", "PLOC2"))
+        elif reader == "biopython":
+            from Bio import SeqIO
+
+            self.sanger_data = SeqIO.read(self.sanger_file, "abi")
+            self._readTags(self.sanger_data.annotations["abif_raw"], str(self.sanger_data.seq),
+                           self.sanger_data.annotations["abif_raw"]["PLOC1"])
+        else:
+            raise ValueError("Unknown reader: " + str(reader))
+
+    def _readTags(self, abif_raw, sanger_seq, base_locations):
+        """从 ABIF 标签 (ABIFReader 或 Biopython 的 abif_raw) 复制出碱基序列、峰值位置、质量值和信号"""
+        self.sanger_seq = sanger_seq.upper()
+
+        # 每个碱基的测序峰值位置(PLOC1)，以及对应的碱基(ASCII码)
+        n_bases = min(len(self.sanger_seq), len(base_locations))
+        self.base_locations = np.array(base_locations[:n_bases], dtype=np.int64)
+        self.base_calls = np.frombuffer(self.sanger_seq[:n_bases].encode("ascii"), dtype=np.uint8)
+
+        # 每个碱基的质量值 (PCON)，没有或长度不够时为空数组
+        qualities = next((abif_raw[tag] for tag in ("PCON2", "PCON1") if tag in abif_raw), b"")
+        qualities = np.frombuffer(bytes(qualities), dtype=np.uint8)
+        self.qualities = qualities[:len(self.sanger_seq)] if len(qualities) >= len(self.sanger_seq) \
+            else np.empty(0, dtype=np.uint8)
+
+        # 信号矩阵，(4, N)，行顺序与 CHANNELS 一致
+        self.traces = np.vstack([np.asarray(abif_raw[tag], dtype=np.int32) for tag in CHANNEL_TAGS])
+
+    def toArrays(self):
+        """解析结果的全部数组，用于缓存"""
+        return {"sequence": np.frombuffer(self.sanger_seq.encode("ascii"), dtype=np.uint8),
+                "base_locations": self.base_locations,
+                "base_calls": self.base_calls,
+                "qualities": self.qualities,
+                "traces": self.traces}
+
+    @cached_property
+    def sanger_data(self):
+        """完整的 Biopython 记录，只在确实需要时才解析"""
+        from Bio import SeqIO
+
+        return SeqIO.read(self.sanger_file, "abi")
+
+    @property
+    def trace(self):
+        """每个信号通道的信号值，均为 self.traces 的视图"""
+        return dict(zip(CHANNELS, self.traces))
+
+    @property
+    def annotation(self):
+        """每个碱基位置上分别是什么碱基和他对应的测序峰值位置"""
+        return _BaseAnnotationView(self)
+
+    @property
+    def location_base_annotation(self):
+        return _LocationBaseView(self)
+
+    @property
+    def labels(self):
+        """根据信号峰值填入碱基位置"""
+        return _LabelView(self)
+
+    @cached_property
+    def _location_index(self):
+        # 采样点 -> 碱基序号，没有峰值的位置为 -1
+        index = np.full(int(self.base_locations.max(initial=-1)) + 1, -1, dtype=np.int64)
+        index[self.base_locations] = np.arange(len(self.base_locations))
+        return index
+
+    def _baseIndex(self, loc):
         try:
-            alignment_2[0]
-        except:
-            alignment_2 = [[0, 0, 0]]
+            loc = int(loc)
+        except (TypeError, ValueError):
+            return -1
+        if 0 <= loc < len(self._location_index):
+            return int(self._location_index[loc])
+        return -1
+
+    def align(self, target_seq, max_mismatch=10, aligner=None):
+        """比对参考序列，返回完整的 AlignmentHit (前三项即 locTartet 的结果)，同时记在 self.hit。
+        只比对修剪后的区间，结果中的坐标换算回完整的测序序列"""
+        aligner = self.aligner if aligner is None else getAligner(aligner)
+        target_seq = str(target_seq).upper()
+        # 最近一次比对的结果是否来自磁盘缓存
+        self.alignment_cached = False
+        if self.cache is None:
+            self.hit = self._locate(aligner, target_seq, max_mismatch)
+            return self.hit
+
+        params = aligner.params + (max_mismatch, self.trim_cutoff)
+        hit = self.cache.loadAlignment(self.digest, target_seq, params)
+        if hit is None:
+            hit = self._locate(aligner, target_seq, max_mismatch)
+            self.cache.saveAlignment(self.digest, target_seq, params, hit)
+        else:
+            count("alignments.cached")
+            self.alignment_cached = True
+        self.hit = hit
+        return hit
+
+    def _locate(self, aligner, target_seq, max_mismatch):
+        query = self.sanger_seq[self.trim_start:self.trim_end]
+        count("alignments.computed")
+        with stage("align"):
+            return aligner.locate(target_seq, query, max_mismatch).offsetQuery(self.trim_start)
+
+    def locTartet(self, target_seq, max_mismatch=10, aligner=None):
+        """在测序序列中找到参考序列(或其反向互补)的比对区域，aligner 默认使用构造时指定的后端。
+        返回 (match_seq, location_start, location_end)"""
+        return tuple(self.align(target_seq, max_mismatch, aligner)[:3])
+
+    def methylationFractions(self, target_seq, hit=None):
+        """参考序列每个位置上的 C/(C+T) 峰高比例，取自该位置对应碱基的峰值处 (PLOC1)。
+        测序结果与参考序列反向互补时用 G/(G+A)。不是 C、没有比对上或两个峰都为 0 的位置为 NaN"""
+        target_seq = str(target_seq).upper()
+        hit = self.align(target_seq) if hit is None else hit
+        with stage("fractions"):
+            return self._fractions(target_seq, hit)
+
+    def _fractions(self, target_seq, hit):
+        ref_length = len(target_seq)
+        fractions = np.full(ref_length, np.nan)
+
+        read_index = hit.referenceToRead(ref_length)
+        is_c = np.frombuffer(target_seq.encode("ascii"), dtype=np.uint8) == ord("C")
+        sites = np.flatnonzero(is_c & (read_index >= 0) & (read_index < len(self.base_locations)))
+        if not len(sites):
+            return fractions
+
+        peaks = self.base_locations[read_index[sites]]
+        inside = peaks < self.traces.shape[1]
+        sites, peaks = sites[inside], peaks[inside]
+        methylated, converted = ("C", "T") if hit.strand == 1 else ("G", "A")
+        c = self.traces[CHANNELS.index(methylated), peaks].astype(np.float64)
+        t = self.traces[CHANNELS.index(converted), peaks].astype(np.float64)
+        total = c + t
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fractions[sites] = np.where(total > 0, c / total, np.nan)
+        return fractions
+
+
+class AnalysisSession:
+    """一次分析运行内的复用：同一个测序文件只解析一次，同一对 (测序文件, 参考序列) 只比对一次。
+    参考序列的反向互补和转换结果由 aligner 模块按序列缓存"""
+
+    def __init__(self, reader="abif", cache=None, aligner=DEFAULT_ALIGNER, trim_cutoff=DEFAULT_TRIM_CUTOFF):
+        self.reader = reader
+        self.cache = cache
+        self.aligner = getAligner(aligner)
+        self.trim_cutoff = trim_cutoff
+        self.traces = {}
+        self.alignments = {}
+        # alignment_misses 中 alignment_cached 次是从磁盘缓存读出的，其余是真正比对的
+        self.stats = {"trace_hits": 0, "trace_misses": 0, "alignment_hits": 0, "alignment_misses": 0,
+                      "alignment_cached": 0}
+
+    @staticmethod
+    def _key(sanger_file):
+        return os.path.normcase(os.path.abspath(sanger_file.strip()))
+
+    def getTrace(self, sanger_file):
+        key = self._key(sanger_file)
+        if key in self.traces:
+            self.stats["trace_hits"] += 1
+        else:
+            self.stats["trace_misses"] += 1
+            self.traces[key] = SangerBaseCall(key, reader=self.reader, cache=self.cache, aligner=self.aligner,
+                                              trim_cutoff=self.trim_cutoff)
+        return self.traces[key]
 
-        if alignment_2[0][2] > alignment_1[0][2]:
-            alignment = alignment_2
+    def align(self, sanger_file, target_seq, max_mismatch=10):
+        """等同于 getTrace(sanger_file).align(target_seq, max_mismatch)，返回 AlignmentHit"""
+        target_seq = str(target_seq).upper()
+        key = (self._key(sanger_file), target_seq, max_mismatch)
+        if key in self.alignments:
+            self.stats["alignment_hits"] += 1
         else:
-            alignment = alignment_1
-        # print(alignment)
+            self.stats["alignment_misses"] += 1
+            trace = self.getTrace(sanger_file)
+            self.alignments[key] = trace.align(target_seq, max_mismatch)
+            if trace.alignment_cached:
+                self.stats["alignment_cached"] += 1
+        return self.alignments[key]
+
+    def fractions(self, sanger_file, target_seq, max_mismatch=10):
+        """参考序列每个位置的 C/(C+T) 峰高比例，见 SangerBaseCall.methylationFractions"""
+        hit = self.align(sanger_file, target_seq, max_mismatch)
+        return self.getTrace(sanger_file).methylationFractions(target_seq, hit)
+
+    def hitRate(self, kind):
+        """kind 为 "trace" 或 "alignment"，还没有请求时返回 0"""
+        hits, misses = self.stats[kind + "_hits"], self.stats[kind + "_misses"]
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def summary(self):
+        return ("traces: %(trace_hits)d reused / %(trace_misses)d parsed, "
+                "alignments: %(alignment_hits)d reused / %(alignment_misses)d new "
+                "(%(alignment_cached)d loaded from cache)") % self.stats
+
+
+# 表格中的一行：参考序列名、参考序列、测序文件列表及其样品名、额外/排除的位置
+AnalysisRow = namedtuple("AnalysisRow", "name ref_sequence sanger_files sanger_names add_locs exc_locs")
+
+
+
+def parseLocations(text):
+    """"1,2，3" -> [1, 2, 3]，无法解析时返回空列表"""
+    try:
+        return [int(loc) for loc in str(text).replace("，", ",").split(",")]
+    except ValueError:
+        return []
+
+
+def sangerName(sanger_file, sep="_"):
+    """样品名取文件名中第一个分隔符之前的部分"""
+    return str(os.path.basename(sanger_file)).split(sep)[0]
+
+
+def rowsFromSheet(sheet, sep="_"):
+    """把界面导出的表格 (DataFrame，列为 Ref Name, Ref Sequence, Sequencing Files,
+    Additional locations, Excluded locations) 转成 AnalysisRow 列表。
+    缺少名字、序列或测序文件的行被跳过，返回 (表格行号, AnalysisRow) 列表"""
+    import pandas as pd
+
+    rows = []
+    for position in range(len(sheet.index)):
+        record = sheet.iloc[position]
+
+        def text(column):
+            value = record.get(column, "")
+            return "" if pd.isna(value) else str(value).strip()
+
+        name, ref_sequence, files = text("Ref Name"), text("Ref Sequence"), text("Sequencing Files")
+        if not (name and ref_sequence and files):
+            continue
+        sanger_files = [f.strip() for f in files.split(",") if f.strip()]
+        rows.append((position, AnalysisRow(name, ref_sequence, sanger_files,
+                                           [sangerName(f, sep) for f in sanger_files],
+                                           parseLocations(text("Additional locations")),
+                                           parseLocations(text("Excluded locations")))))
+    return rows
+
+
+# BatchEngine.profile 的输出目录，在 save_path 下
+PROFILE_DIR = "profile"
+
+# 子进程内的会话，由 _initWorker 创建
+_worker_session = None
+
+
+def _initWorker(reader, aligner, trim_cutoff, cache_path=None):
+    """cache_path 为主进程缓存的目录，子进程直接读写其中的条目，索引的变化随结果交回主进程"""
+    global _worker_session
+    cache = None if cache_path is None else AnalysisCache(cache_path, max_size=None)
+    _worker_session = AnalysisSession(reader=reader, cache=cache, aligner=aligner, trim_cutoff=trim_cutoff)
+
+
+def _alignChunk(tasks, quantitative, min_snr=DEFAULT_MIN_SNR, max_secondary=None):
+    """子进程中比对一组 (测序文件, 参考序列, max_mismatch)，
+    返回 ([(AlignmentHit, 峰高比例或 None, TraceQC, 比对是否来自缓存)], 计时, 缓存索引的变化)。
+    质控不合格的测序不比对，AlignmentHit 为 None；计时为这一组在子进程中的增量 (见 instrument.Recorder.since)，
+    缓存索引的变化见 AnalysisCache.takeChanges，没有缓存时为空"""
+    before = recorder().snapshot()
+    results = []
+    for task in tasks:
+        trace = _worker_session.getTrace(task[0])
+        if trace.qc.failures(min_snr, max_secondary):
+            results.append((None, None, trace.qc, False))
+            continue
+        hit = _worker_session.align(*task)
+        results.append((hit, trace.methylationFractions(task[1], hit) if quantitative else None, trace.qc,
+                        trace.alignment_cached))
+    cache = _worker_session.cache
+    return results, recorder().since(before), {} if cache is None else cache.takeChanges()
+
+
+class BatchEngine:
+    """把测序文件的解析和比对分发到进程池，按表格行的顺序逐行返回结果。
+
+    所有行的比对任务一开始就提交，调用方在处理(生成报告)当前行时，进程池继续比对后面的行。
+    workers <= 1 时不开进程池，直接在当前进程里运行。
+    缓存只在主进程读写：命中的比对不再提交，子进程算出的结果由主进程写入缓存。
+    信噪比低于 min_snr (或次峰比例高于 max_secondary) 的测序在比对前剔除，不进入报告。
+    """
+
+    def __init__(self, workers=None, chunksize=4, reader="abif", aligner=DEFAULT_ALIGNER, cache=None,
+                 max_mismatch=10, quantitative=True, min_snr=DEFAULT_MIN_SNR, max_secondary=None,
+                 trim_cutoff=DEFAULT_TRIM_CUTOFF, store=None, streaming=False, metrics=None, report_stats=False):
+        """quantitative 为 True 时同时从信号峰高计算每个 C 位点的 C/(C+T) 比例。
+        min_snr、max_secondary 为质控阈值，None 表示不检查该项。trim_cutoff 见 SangerBaseCall。
+        store 为 store.ResultStore 时，analyse 把每行的位点判断写入结果库，每次 analyse 为一个批次。
+        streaming 为 True 时 run 改用 pipeline 模块的流水线：同时在途的任务数有上限、不在行间复用结果，
+        内存不随批量大小增长，适合一次处理成千上万个测序文件。
+        metrics 为 instrument.MetricsLog 时，每个测序文件 ("file")、每行 ("row") 和每次 analyse ("run") 写一条记录；
+        report_stats 为 True 时每份报告末尾加一节该行各环节的耗时"""
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.chunksize = max(int(chunksize), 1)
+        self.reader = reader
+        self.aligner = getAligner(aligner)
+        self.cache = cache
+        self.max_mismatch = max_mismatch
+        self.quantitative = quantitative
+        self.min_snr = min_snr
+        self.max_secondary = max_secondary
+        self.trim_cutoff = trim_cutoff
+        self.store = store
+        self.streaming = streaming
+        self.metrics = metrics
+        self.report_stats = report_stats
+        # 实际比对、行间复用、缓存命中、质控剔除的次数，以及 analyse 增量分析时跳过、只重新出报告的行数
+        self.stats = {"alignments": 0, "reused": 0, "cached": 0, "rejected": 0, "skipped": 0, "rerendered": 0}
+        self._cancelled = threading.Event()
+        # analyse 开始时的计时和缓存计数，runStats 以此为起点
+        self._started = None
+
+    def summary(self):
+        return ("alignments: %(alignments)d computed, %(reused)d reused across rows, "
+                "%(cached)d loaded from cache, %(rejected)d traces rejected by QC; "
+                "rows: %(skipped)d unchanged, %(rerendered)d re-rendered") % self.stats
+
+    @property
+    def params(self):
+        """影响比对和质控结果的参数，用于判断保存的结果是否还能用 (见 manifest.RowManifest)"""
+        return (self.reader,) + tuple(self.aligner.params) + (self.max_mismatch, self.quantitative, self.min_snr,
+                                                              self.max_secondary, self.trim_cutoff)
+
+    def cancel(self):
+        """请求停止：run 在下一个测序文件之前返回，还没开始的任务被取消。可从其他线程调用"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self, rows, progress=None):
+        """逐行产出 (行序号, AnalysisRow, sub_result, fractions, qc)，sub_result 即 BSReport 的输入
+        (参考序列及按其坐标排好的各测序结果，见 AlignmentHit.alignedRead)，
+        fractions 为 (测序文件数, 参考序列长度) 的 C/(C+T) 峰高比例 (quantitative 为 False 时是 None)。
+        质控剔除的测序文件不在产出的 AnalysisRow、sub_result 和 fractions 中；
+        qc 为该行全部测序文件的 [(样品名, 测序文件, TraceQC, 不合格原因)]。
+        每个测序文件处理完成后调用 progress(已完成文件数, 文件总数, 测序文件)"""
+        rows = list(rows)
+        if self.streaming:
+            yield from self._stream(rows, progress)
+            return
+        total = sum(len(row.sanger_files) for row in rows)
+        pool = session = None
+        try:
+            if self.workers <= 1:
+                session = AnalysisSession(self.reader, self.cache, self.aligner, self.trim_cutoff)
+
+                def align(sanger_file, ref_sequence):
+                    trace = session.getTrace(sanger_file)
+                    if trace.qc.failures(self.min_snr, self.max_secondary):
+                        return None, None, trace.qc
+                    hit = session.align(sanger_file, ref_sequence, self.max_mismatch)
+                    if not self.quantitative:
+                        return hit, None, trace.qc
+                    return hit, trace.methylationFractions(ref_sequence, hit), trace.qc
+            else:
+                if self.cache is not None:
+                    # 子进程按启动时的索引查找，先写回
+                    self.cache.flush()
+                pool = ProcessPoolExecutor(self.workers, initializer=_initWorker,
+                                           initargs=(self.reader, self.aligner, self.trim_cutoff,
+                                                     None if self.cache is None else self.cache.path))
+                align = self._submit(pool, rows)
+
+            finished = 0
+            for index, row in enumerate(rows):
+                sub_result = [row.ref_sequence]
+                fractions = []
+                qc_records = []
+                kept = []
+                for sanger_file, sanger_name in zip(row.sanger_files, row.sanger_names):
+                    if self.cancelled:
+                        return
+                    hit, fraction, qc = align(sanger_file, row.ref_sequence)
+                    reasons = qc.failures(self.min_snr, self.max_secondary)
+                    qc_records.append((sanger_name, sanger_file, qc, reasons))
+                    self._fileDone(row.name, sanger_name, sanger_file, qc, reasons)
+                    if reasons:
+                        self.stats["rejected"] += 1
+                    else:
+                        kept.append((sanger_file, sanger_name))
+                        # 修剪后的测序结果不一定从参考序列的起点开始，按参考序列坐标对齐后再比较
+                        sub_result.append(hit.alignedRead(len(row.ref_sequence)))
+                        fractions.append(fraction)
+                    finished += 1
+                    if progress is not None:
+                        progress(finished, total, sanger_file)
+                if self.quantitative:
+                    fractions = np.array(fractions).reshape(len(fractions), len(row.ref_sequence))
+                else:
+                    fractions = None
+                if len(kept) < len(row.sanger_files):
+                    row = row._replace(sanger_files=[f for f, _ in kept], sanger_names=[n for _, n in kept])
+                yield index, row, sub_result, fractions, qc_records
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            if session is not None:
+                # 与 _submit 的计数一致：磁盘缓存读出的比对只算 cached
+                self.stats["alignments"] += session.stats["alignment_misses"] - session.stats["alignment_cached"]
+                self.stats["cached"] += session.stats["alignment_cached"]
+                self.stats["reused"] += session.stats["alignment_hits"]
+
+    def _stream(self, rows, progress):
+        from pipeline import readCalls, rowResults
+
+        total = sum(len(row.sanger_files) for row in rows)
+        calls = readCalls(rows, self.workers, self.chunksize, self.reader, self.aligner, self.cache,
+                          self.max_mismatch, self.quantitative, self.min_snr, self.max_secondary, self.trim_cutoff)
+
+        def counted(calls):
+            for finished, call in enumerate(calls, 1):
+                if self.cancelled:
+                    return
+                self.stats["rejected" if call.reasons else "cached" if call.cached else "alignments"] += 1
+                self._fileDone(call.task.row.name, call.task.sanger_name, call.task.sanger_file, call.qc,
+                               call.reasons)
+                if progress is not None:
+                    progress(finished, total, call.task.sanger_file)
+                yield call
 
-        if target_is_reversed:
-            location_start = alignment[0][4]
-            location_end = alignment[0][3]
-            # match_seq = str(alignment[location_end][location_start]).upper()
+        try:
+            # 取消时 counted 提前结束，rowResults 只产出已经到齐的行
+            yield from rowResults(counted(calls), self.quantitative, rows)
+        finally:
+            calls.close()
+
+    def _fileDone(self, row_name, sanger_name, sanger_file, qc, reasons):
+        count("files")
+        if reasons:
+            count("files.rejected")
+        if self.metrics is not None:
+            self.metrics.write("file", row=row_name, sample=sanger_name, file=sanger_file,
+                               status="rejected" if reasons else "passed", reasons=reasons,
+                               snr=round(float(qc.snr), 2), secondary=round(float(qc.secondary_ratio), 3))
+
+    def _submit(self, pool, rows):
+        """提交全部去重后的比对任务，返回按 (测序文件, 参考序列) 取 (AlignmentHit, 峰高比例, TraceQC) 的函数。
+        有缓存时子进程自己读写缓存，解析、质控、比对和峰高比例都不在主进程里做"""
+        done = {}
+        pending = {}
+        chunk = []
+        # 已经合并过计时和缓存索引的任务组
+        merged = set()
+        # 已经取过结果的任务，再次取到且比对过的算作行间复用 (与单进程方式的 AnalysisSession 一致)
+        resolved = set()
+
+        def key(sanger_file, ref_sequence):
+            return AnalysisSession._key(sanger_file), str(ref_sequence).upper()
+
+        def flush():
+            future = pool.submit(_alignChunk, [task + (self.max_mismatch,) for task in chunk], self.quantitative,
+                                 self.min_snr, self.max_secondary)
+            for position, task in enumerate(chunk):
+                pending[task] = (future, position)
+            chunk.clear()
+
+        for row in rows:
+            for sanger_file in row.sanger_files:
+                task = key(sanger_file, row.ref_sequence)
+                if task in pending or task in chunk:
+                    continue
+                chunk.append(task)
+                if len(chunk) >= self.chunksize:
+                    flush()
+        if chunk:
+            flush()
+
+        def resolve(sanger_file, ref_sequence):
+            task = key(sanger_file, ref_sequence)
+            if task not in done:
+                future, position = pending.pop(task)
+                # 主进程等待子进程的时间
+                with stage("wait"):
+                    results, delta, changes = future.result()
+                if future not in merged:
+                    merged.add(future)
+                    recorder().merge(delta)
+                    if self.cache is not None:
+                        self.cache.mergeChanges(changes)
+                hit, fraction, qc, cached = results[position]
+                done[task] = (hit, fraction, qc)
+                # 质控不合格的没有比对，不计数
+                if hit is not None:
+                    self.stats["cached" if cached else "alignments"] += 1
+            hit, fraction, qc = done[task]
+            if task in resolved and hit is not None:
+                self.stats["reused"] += 1
+            resolved.add(task)
+            return hit, fraction, qc
+
+        return resolve
+
+    def analyse(self, rows, save_path="", progress=None, run_label=None, manifest=None, **report_options):
+        """比对并生成报告，逐行产出 (行序号, 报告路径)。run_label 为结果库中这一批次的名字。
+        report_options (cluster_rows、assets、sheet_formats) 原样传给 BSReport.generateReport。
+        manifest 为 manifest.RowManifest 时增量分析：输入和选项都没变的行直接跳过，
+        只改了作图选项的行用保存的比对结果重新出报告，只有其余的行交给 run 比对"""
+        rows = list(rows)
+        # 每次 analyse 重新计数
+        self.stats = dict.fromkeys(self.stats, 0)
+        self._started = (time.perf_counter(), recorder().snapshot())
+        # 报告中有耗时一节时，开关它也算改了作图选项
+        render_options = dict(report_options, run_stats=True) if self.report_stats else report_options
+        try:
+            yield from self._analyse(rows, save_path, progress, run_label, manifest, report_options, render_options)
+        finally:
+            if self.metrics is not None:
+                self.metrics.write("run", label=run_label, **self.runStats())
+
+    def _analyse(self, rows, save_path, progress, run_label, manifest, report_options, render_options):
+        if manifest is None:
+            plans = [ANALYSE] * len(rows)
         else:
-            location_start = alignment[0][3]
-            location_end = alignment[0][4]
-            match_seq = str(alignment[0][1][location_start:location_end]).upper()
+            with stage("manifest"):
+                plans = [manifest.plan(row, self.params, render_options) for row in rows]
+        self.stats.update(skipped=plans.count(SKIP), rerendered=plans.count(RENDER))
+        results = self.run([row for row, plan in zip(rows, plans) if plan == ANALYSE], progress)
+        # 结果库中的批次在第一行真正分析时才建，全部跳过或只重新出报告时不留下空批次
+        run = None
+        # run 的产出按行序号对应交给它的行
+        analysed = 0
+        for index, (row, plan) in enumerate(zip(rows, plans)):
+            count("rows." + plan)
+            if plan == SKIP:
+                self._rowDone(row, plan, None, 0.0)
+                yield index, manifest.reportPath(row)
+                continue
+            started, before = time.perf_counter(), recorder().snapshot()
+            if plan == RENDER:
+                kept, sub_result, fractions, qc = manifest.load(row)
+            else:
+                result = next(results, None)
+                if result is None:
+                    # 取消了
+                    return
+                if result[0] != analysed:
+                    raise RuntimeError("result for row %d arrived in place of row %d (%s)"
+                                       % (result[0], analysed, row.name))
+                analysed += 1
+                _, kept, sub_result, fractions, qc = result
+            with stage("call"):
+                report = BSReport(sub_result, fractions=fractions)
+            if self.store is not None and plan == ANALYSE:
+                with stage("store"):
+                    if run is None:
+                        run = self.store.beginRun(run_label)
+                    self.store.addReport(run, kept, report)
+            report_path = report.generateReport(ref_seq=kept.ref_sequence, sanger_names=kept.sanger_names,
+                                                add_locs=kept.add_locs, exc_locs=kept.exc_locs,
+                                                report_name=kept.name, save_path=save_path, qc=qc,
+                                                stats_since=before if self.report_stats else None,
+                                                **report_options)
+            if manifest is not None:
+                with stage("manifest"):
+                    manifest.record(row, self.params, render_options, kept, sub_result, fractions, qc, report_path,
+                                    report.outputs)
+            self._rowDone(row, plan, recorder().since(before), time.perf_counter() - started)
+            yield index, report_path
+
+    def _rowDone(self, row, plan, delta, wall):
+        if self.metrics is not None:
+            self.metrics.write("row", row=row.name, plan=plan, files=len(row.sanger_files), wall=round(wall, 4),
+                               stages=_roundStages(delta["stages"]) if delta else {},
+                               counters=delta["counters"] if delta else {})
+
+    def runStats(self):
+        """最近一次 analyse 的统计：总耗时、各环节 {名字: [次数, 墙钟秒数, CPU 秒数]}、计数、
+        缓存命中率 (行间复用和磁盘缓存)、峰值内存 (MB) 以及 stats。子进程的计时是各进程的总和"""
+        if self._started is None:
+            return {}
+        started, before = self._started
+        delta = recorder().since(before)
+        requested = self.stats["alignments"] + self.stats["reused"] + self.stats["cached"]
+        cache = {"reuse_rate": round(self.stats["reused"] / requested, 3) if requested else 0.0}
+        if self.cache is not None:
+            # 按解析和比对的计数算，包括子进程里的缓存命中
+            counters = delta["counters"]
+            hits = counters.get("traces.cached", 0) + counters.get("alignments.cached", 0)
+            misses = counters.get("traces.parsed", 0) + counters.get("alignments.computed", 0)
+            cache.update(disk_hits=hits, disk_misses=misses,
+                         disk_hit_rate=round(hits / (hits + misses), 3) if hits + misses else 0.0)
+        return {"wall": round(time.perf_counter() - started, 4), "stages": _roundStages(delta["stages"]),
+                "counters": delta["counters"], "cache": cache, "peak_memory_mb": peakMemory(),
+                "stats": dict(self.stats)}
+
+    def statsText(self):
+        """runStats 的一行摘要，用于状态栏"""
+        stats = self.runStats()
+        if not stats:
+            return ""
+        rows = sum(value for name, value in stats["counters"].items() if name.startswith("rows."))
+        text = "%d rows, %d files in %.1fs" % (rows, stats["counters"].get("files", 0), stats["wall"])
+        stages = formatStages(stats)
+        if stages:
+            text += "; " + stages
+        if self.cache is not None and stats["cache"]["disk_hits"] + stats["cache"]["disk_misses"]:
+            text += "; cache %d%% hits" % round(stats["cache"]["disk_hit_rate"] * 100)
+        if stats["peak_memory_mb"]["self"] is not None:
+            text += "; peak %d MB" % stats["peak_memory_mb"]["self"]
+        return text
+
+    def profile(self, row, save_path="", output=None, **report_options):
+        """用 cProfile 分析单独一行 (在当前进程中，不开进程池，也不用增量清单和结果库)，返回 pstats.Stats。
+        报告和数据表写在 save_path 下的 PROFILE_DIR 里，不覆盖增量分析记录过的输出。
+        output 不为 None 时把结果存成 .prof 文件，可以用 snakeviz 等工具查看"""
+        import cProfile
+        import importlib
+        import pstats
+
+        # 先导入报告用到的模块，导入时间不算在这一行里
+        for module in ("pandas", "htmlreport", "render"):
+            importlib.import_module(module)
+
+        save_path = os.path.join(save_path, PROFILE_DIR)
+        os.makedirs(save_path, exist_ok=True)
+        workers, store, self.workers, self.store = self.workers, self.store, 1, None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            for _ in self.analyse([row], save_path, **report_options):
+                pass
+        finally:
+            profiler.disable()
+            self.workers, self.store = workers, store
+        if output is not None:
+            profiler.dump_stats(output)
+        return pstats.Stats(profiler)
 
-        return (match_seq, location_start, location_end)
+
+def _roundStages(stages):
+    return {name: [calls, round(wall, 4), round(cpu, 4)] for name, (calls, wall, cpu) in stages.items()}
 
 
 class BSReport:
-    def __init__(self, sub_result_list):
+    def __init__(self, sub_result_list, fractions=None, renderer=None):
         # 如果碱基发生变化，说明没有发生甲基化。0
         # 如果碱基没变，说明有甲基化，记为1
         # 将碱基转换成数字矩阵
+        # fractions: 可选，(测序文件数, 参考序列长度) 的 C/(C+T) 峰高比例，用于画定量热图
+        # renderer: 出图用的 render.FigureRenderer，默认每个线程共用一个
         self.ref = sub_result_list[0]
         self.seqs = sub_result_list[1:]
-        self.C_loc = []
-        self.CG_loc = []
-        for i in range(len(self.ref)):
-            if self.ref[i] == "C":
-                self.C_loc.append(i)
-            if i > 0:
-                if self.ref[i] == "G" and self.ref[i - 1] == "C":
-                    self.CG_loc.append(i - 1)
+        self.fractions = None if fractions is None else np.asarray(fractions, dtype=np.float64)
+        self.renderer = renderer
+        # generateReport 写出的文件
+        self.outputs = []
+
+        # (测序文件数, 参考序列长度) 的 uint8 矩阵，比参考序列短的比对结果用 0 补齐
+        ref_length = len(self.ref)
+        self.ref_array = np.frombuffer(self.ref.encode("ascii"), dtype=np.uint8)
+        padded = b"".join(seq.encode("ascii")[:ref_length].ljust(ref_length, b"\0") for seq in self.seqs)
+        self.matrix = np.frombuffer(padded, dtype=np.uint8).reshape(len(self.seqs), ref_length)
+
+        # 每个测序结果在每个位置上的甲基化判断：参考序列是 C 且测序结果没变
+        self.site_masks = self.siteMasks(self.ref_array)
+        self.calls = (self.matrix == self.ref_array) & self.site_masks["C"]
+
+        self.C_loc = np.flatnonzero(self.site_masks["C"]).tolist()
+        self.CG_loc = np.flatnonzero(self.site_masks["CG"]).tolist()
+
+    @staticmethod
+    def siteMasks(ref_array):
+        """参考序列上 C、CpG、CHG、CHH 位点(均标在 C 上)的布尔掩码"""
+        c = ref_array == ord("C")
+        g = ref_array == ord("G")
+        next_g = np.zeros_like(g)
+        next_g[:-1] = g[1:]
+        next2_g = np.zeros_like(g)
+        next2_g[:-2] = g[2:]
+        # CHG/CHH 需要后面还有碱基
+        has_next = np.zeros_like(g)
+        has_next[:-1] = True
+        has_next2 = np.zeros_like(g)
+        has_next2[:-2] = True
+        return {
+            "C": c,
+            "CG": c & next_g,
+            "CHG": c & has_next2 & ~next_g & next2_g,
+            "CHH": c & has_next2 & ~next_g & ~next2_g,
+        }
+
+    def sequenceSheet(self, sanger_names, tidy=False):
+        """每个测序结果在参考序列各位置上的碱基。tidy 为 False 时是宽表 (每个位置一列，最后一行为参考序列)，
+        为 True 时是长表 (sample, position, reference, base, call)，见 sheets.tidySequences"""
+        import pandas as pd
+
+        if tidy:
+            from sheets import tidySequences
+
+            return tidySequences([str(name) for name in sanger_names], self.matrix, self.ref_array, self.calls)
+        bases = np.vstack([self.matrix, self.ref_array]).view("S1").astype(str)
+        return pd.DataFrame(bases, index=list(sanger_names) + ["Reference"], columns=range(1, len(self.ref) + 1))
+
+    def siteCalls(self, context="C"):
+        """某类位点上的 (位点列表, 每个位点的甲基化条数, (测序文件数, 位点数) 的 0/1 矩阵)"""
+        loc = np.flatnonzero(self.site_masks[context])
+        data = self.calls[:, loc].astype(np.uint8)
+        return loc, data.sum(axis=0), data
+
+    def _peak(self, context):
+        loc, counts, data = self.siteCalls(context)
+        return dict(zip(loc.tolist(), counts.tolist())), data
 
     def getmCG(self):
-        # print(self.seq)
-        CG_peak = {}
-        raw_data = []
-        for loc in self.CG_loc:
-            CG_peak[loc] = 0
-
-        for seq in self.seqs:
-            data = []
-            for loc in self.CG_loc:
-                if seq[loc] == self.ref[loc]:
-                    CG_peak[loc] = CG_peak[loc] + 1
-                    data.append(1)
-                else:
-                    data.append(0)
-            raw_data.append(data)
-
-        self.mCG_peak = CG_peak
+        self.mCG_peak, raw_data = self._peak("CG")
         return (self.mCG_peak, raw_data)
 
     def getmC(self):
-        # print(self.seq)
-        C_peak = {}
-        raw_data = []
-        for loc in self.C_loc:
-            C_peak[loc] = 0
-
-        for seq in self.seqs:
-            data = []
-            for loc in self.C_loc:
-                if seq[loc] == self.ref[loc]:
-                    C_peak[loc] = C_peak[loc] + 1
-                    data.append(1)
-                else:
-                    data.append(0)
-            raw_data.append(data)
-
-        self.mC_peak = C_peak
+        self.mC_peak, raw_data = self._peak("C")
         return (self.mC_peak, raw_data)
 
-    def plotPeakMap(self, peak_dic, title=""):
-        plot_val = []
-        for i in range(len(self.ref)):
-            if i in peak_dic:
-                plot_val.append(peak_dic[i])
-            else:
-                plot_val.append(0)
+    def _renderer(self):
+        if self.renderer is None:
+            from render import defaultRenderer
 
+            self.renderer = defaultRenderer()
+        return self.renderer
 
-        plt.cla()
-        plt.close("all")
-        plt.rcParams['figure.figsize'] = (15, 4)
-        colors = "black"
-        fig, ax = plt.subplots()
-        ax.plot(plot_val, color=colors[0], label='G')
-        plt.xlabel("Reference sequence")
-        plt.ylabel('Nums of methylation')
-        plt.title(title)
-        return plt
+    def plotPeakMap(self, peak_dic, title=""):
+        """返回 matplotlib Figure，画下一张同类图时会被复用，需要先保存"""
+        plot_val = np.zeros(len(self.ref), dtype=np.int64)
+        plot_val[list(peak_dic.keys())] = list(peak_dic.values())
+        return self._renderer().peakMap(plot_val, title=title)
 
-    def plotHeatMap(self, peak_dic, add_locs=[], exc_locs=[], title="",rows = []):
+    def _plotLocations(self, peak_dic, add_locs, exc_locs):
+        """热图要画的位置 (从 0 开始)，以及其中落在参考序列内的列"""
         plot_loc = list(peak_dic.keys())
 
         for i in add_locs:
@@ -174,72 +878,70 @@ class BSReport:
 
         plot_loc.sort()
 
-        data = []
+        columns = np.array(plot_loc, dtype=np.int64)
+        inside = (columns >= 0) & (columns < len(self.ref))
+        return plot_loc, columns, inside
 
-        for seq in self.seqs:
-            sub_data = []
-            for loc in plot_loc:
-                # print(seq[loc],self.ref[loc])
-                if seq[loc] == self.ref[loc]:
-                    if self.ref[loc] == "C":
-                        sub_data.append(1)
-                        # print(1)
-                    else:
-                        sub_data.append(0)
-                else:
-                    sub_data.append(0)
-            sub_data.append(0)
-            data.append(sub_data)
-        # data_0 = lst1 = [0] * len(plot_loc)
-        # data.append(data_0)
-        data = np.array(data)
-
-        loc_show = []
-        for loc in plot_loc:
-            loc_show.append(loc + 1)
-
-
-        plt.cla()
-        plt.close("all")
-        plt.rcParams['figure.figsize'] = (15, 4)
-        fig, ax = plt.subplots()
-        fig.tight_layout()
-
-        ax.imshow(data, cmap="binary")
-
-        ax.set_xticks(np.arange(data.shape[1] + 1) - .5, minor=True)
-        ax.set_yticks(np.arange(data.shape[0] + 1) - .5, minor=True)
-        ax.grid(which="minor", color="gray", linestyle='-', linewidth=2)
-        ax.set_xticks(np.arange(len(plot_loc)), labels=loc_show)
-        ax.set_yticks(np.arange(len(rows)), labels=rows)
-        plt.xlabel("CG positions")
-        plt.title(title)
-
-        return plt
-
-    def plt2md(self, plt):
-        """将plt转换成markdown图片"""
+    def plotHeatMap(self, peak_dic, add_locs=[], exc_locs=[], title="",rows = []):
+        plot_loc, columns, inside = self._plotLocations(peak_dic, add_locs, exc_locs)
+
+        # 最后补一列 0，与原来的图保持一致；超出参考序列的位置记为 0
+        data = np.zeros((len(self.seqs), len(plot_loc) + 1), dtype=np.uint8)
+        data[:, np.flatnonzero(inside)] = self.calls[:, columns[inside]]
+
+        return self._renderer().heatMap(data, columns=[loc + 1 for loc in plot_loc], rows=list(rows), title=title)
+
+    def plotQuantHeatMap(self, peak_dic, add_locs=[], exc_locs=[], title="", rows=[]):
+        """按信号峰高 C/(C+T) 画的定量热图，需要构造时传入 fractions；没有数据的格子为浅红色"""
+        plot_loc, columns, inside = self._plotLocations(peak_dic, add_locs, exc_locs)
+        data = np.full((len(self.seqs), len(plot_loc)), np.nan)
+        data[:, np.flatnonzero(inside)] = self.fractions[:, columns[inside]]
+
+        return self._renderer().heatMap(data, columns=[loc + 1 for loc in plot_loc], rows=list(rows), title=title,
+                                        vmin=0, vmax=1, colorbar_label="C/(C+T)")
+
+    def heatMapPages(self, peak_dic, add_locs=[], exc_locs=[], title="", rows=[], quantitative=False, cluster=False):
+        """报告里的热图，逐张产出 Figure。矩阵不大时就是 plotHeatMap / plotQuantHeatMap 的一张图，
+        测序文件或位点很多时改用 render 的大矩阵模式 (栅格图、合并、分页)，cluster 为 True 时把相近的测序文件排在一起"""
+        from render import isLarge
+
+        plot_loc, columns, inside = self._plotLocations(peak_dic, add_locs, exc_locs)
+        if not isLarge((len(self.seqs), len(plot_loc))):
+            plot = self.plotQuantHeatMap if quantitative else self.plotHeatMap
+            yield plot(peak_dic, add_locs=add_locs, exc_locs=exc_locs, title=title, rows=rows)
+            return
+
+        data = np.full((len(self.seqs), len(plot_loc)), np.nan)
+        values = self.fractions if quantitative else self.calls
+        data[:, np.flatnonzero(inside)] = values[:, columns[inside]]
+        yield from self._renderer().heatMapPages(data, columns=[loc + 1 for loc in plot_loc], rows=rows, title=title,
+                                                 colorbar_label="C/(C+T)" if quantitative else "Methylated",
+                                                 cluster=cluster)
+
+    def plt2md(self, fig):
+        """将图片(Figure，或任何有 savefig 的对象)转换成markdown图片"""
         buffer = BytesIO()
-        plt.savefig(buffer, format='png')
+        fig.savefig(buffer, format='png')
         # 转换base64并以utf8格式输出
         pic_base64 = base64.b64encode(buffer.getvalue()).decode('utf8')
         md = """![](data:image/png;base64,""" + pic_base64 + """)"""
         return md
 
     def generateReport(self, ref_seq='', sanger_names=range(2), add_locs=[], exc_locs=[], report_name='test',
-                       save_path=''):
+                       save_path='', qc=None, cluster_rows=False, assets="inline",
+                       sheet_formats=DEFAULT_FORMATS, stats_since=None):
+        """qc 为 BatchEngine.run 产出的质控记录 [(样品名, 测序文件, TraceQC, 不合格原因)]，给出时报告中加一节质控。
+        cluster_rows 为 True 时，大矩阵热图中甲基化模式相近的测序文件排在一起。
+        assets 为 "inline" 时图片以 base64 写在 HTML 里；为 "png" 或 "svg" 时存到 Reports/assets/，
+        按内容命名，相同的图在各份报告间只存一份。
+        sheet_formats 为数据表的格式 (见 sheets.FORMATS)，默认只写 csv，xlsx 需要明确要求或之后用 sheets.exportExcel 转换。
+        stats_since 为 instrument.Recorder.snapshot() 的结果，给出时报告末尾列出从那时起各环节的耗时"""
+        import pandas as pd
+        from htmlreport import ReportWriter
+
         C_peak, C_data = self.getmC()
         CG_peak, CG_data = self.getmCG()
 
-        C_peak_map = self.plotPeakMap(C_peak, title="Methalation state of C")
-        C_peak_map_md = self.plt2md(C_peak_map)
-        CG_peak_map = self.plotPeakMap(CG_peak, "Methalation state of CG")
-        CG_peak_map_md = self.plt2md(CG_peak_map)
-
-        CG_heat_map = self.plotHeatMap(CG_peak, add_locs=add_locs, exc_locs=exc_locs,
-                                       title="Methalation status of each sequencing samples",rows=sanger_names)
-        CG_heat_map_md = self.plt2md(CG_heat_map)
-
         C_peak_loc_show = []
         CG_peak_loc_show = []
         for i in list(C_peak.keys()):
@@ -251,15 +953,6 @@ class BSReport:
         C_sheet = pd.DataFrame(C_data, index=sanger_names, columns=C_peak_loc_show)
         CG_sheet = pd.DataFrame(CG_data, index=sanger_names, columns=CG_peak_loc_show)
 
-        sequences = []
-        for seq in self.seqs:
-            sequence = list(seq)
-            sequences.append(sequence)
-        sequence_sheet = pd.DataFrame(sequences, index=sanger_names, columns=range(1,len(ref_seq) + 1))
-        sequence_sheet.loc["Reference"] = list(ref_seq)
-
-
-
         if save_path == "":
             pass
 
@@ -277,13 +970,27 @@ class BSReport:
         except:
             pass
 
-        C_sheet.to_excel(save_path + "Reports/Sheets/" + report_name + "_mC.xlsx")
-        CG_sheet.to_excel(save_path + "Reports/Sheets/" + report_name + "_mCG.xlsx")
-        sequence_sheet.to_excel(save_path + "Reports/Sheets/" + report_name + "_sequence.xlsx")
+        # (链接文字, 文件名后缀, 表格)。序列表在 xlsx 中为宽表，其它格式为长表，都在用到时才生成
+        sheets = [("mC data sheet", "_mC", lambda fmt: C_sheet), ("mCG data sheet", "_mCG", lambda fmt: CG_sheet),
+                  ("Sequence info sheet", "_sequence",
+                   lambda fmt: self.sequenceSheet(sanger_names, tidy=fmt != "xlsx"))]
+        if self.fractions is not None:
+            CG_fraction_sheet = pd.DataFrame(self.fractions[:, list(CG_peak.keys())], index=sanger_names,
+                                             columns=CG_peak_loc_show)
+            sheets.append(("mCG fraction sheet", "_mCG_fraction", lambda fmt: CG_fraction_sheet))
+        data_urls = []
+        # 写出的全部文件：数据表、报告和外部图片
+        self.outputs = []
+        for label, suffix, sheet in sheets:
+            for fmt in sheet_formats:
+                with stage("sheets." + fmt):
+                    path = writeSheet(sheet(fmt), save_path + "Reports/Sheets/" + report_name + suffix, fmt)
+                self.outputs.append(path)
+                text = label if len(sheet_formats) == 1 else label + " (" + fmt + ")"
+                data_urls.append("\n\n[" + text + "](Sheets/" + os.path.basename(path) + ")")
 
         # 网页报告内容
         title = "# BS-Seq Report of " + report_name + "\n"
-        sep = "\n\n-------\n\n"
         description = (
                     "\nThis BS-seq report shows the methalation state of the sequence " + ref_seq[:10] + "..." + ref_seq[
                                                                                                                 -10:] + "\n\n" +
@@ -310,6 +1017,24 @@ class BSReport:
                                    "进行分析的位置有 " + str(CG_sites) + " 以及 " + str(
                     add_locs) + "。\n\n但是根据你设置的参数，" + str(exc_locs) + "这些点没有在图中画出。\n\n   \n\n")
 
+        quant_title = "## Quantitative methylation of each sequencing sample"
+        quant_description = (
+                    "\nThis fig shows C/(C+T) of each CG site, computed from the peak heights of the trace at the aligned base (G/(G+A) for reverse reads). Sites without signal are left light red.\n\n" +
+                    "该图根据测序峰图在比对位置的峰高计算每个CG位点的 C/(C+T) (反向测序为 G/(G+A))，颜色越深甲基化比例越高，没有信号的位置为浅红色。\n\n   \n\n")
+
+        qc_section = []
+        if qc:
+            qc_title = "## Trace quality control"
+            qc_description = (
+                        "\nSignal-to-noise ratio (S/N) and secondary peak ratio of every sequencing file, measured at the called peaks after subtracting a sliding-window baseline. Rejected traces were not aligned and are left out of the figures and data sheets of this report.\n\n" +
+                        "每个测序文件的信噪比和次峰比例 (在各碱基峰值处扣除滑动窗口基线后计算)。未通过质控的测序文件没有进行比对，也不在本报告的图表和数据表中。\n\n")
+            qc_table = ["| Sample | File | S/N | Secondary peaks | Status |", "| --- | --- | --- | --- | --- |"]
+            for name, sanger_file, trace_qc, reasons in qc:
+                qc_table.append("| %s | %s | %.1f | %.2f | %s |" % (
+                    name, os.path.basename(sanger_file), trace_qc.snr, trace_qc.secondary_ratio,
+                    "rejected: " + "; ".join(reasons) if reasons else "passed"))
+            qc_section = [qc_title, qc_description, "\n".join(qc_table) + "\n\n"]
+
         peak_map_title = "## Methalation peaks of C and CG"
         peak_map_description = (
                     "\nThe program calculated all the sequencing data and generated the methalation peak map\n\n" +
@@ -317,28 +1042,57 @@ class BSReport:
 
         data_title = "## Data sheets"
         data_description = (
-                    "\nThese excel files provide methalation infomations of all sequencing file. You can use them to generate pictures like this report, or use them for other purpose.\n\n" +
+                    "\nThese files provide methalation infomations of all sequencing file. You can use them to generate pictures like this report, or use them for other purpose.\n\n" +
                     "这些文件提供了所有测序文件计算出的甲基化情况，你可以用这些数据生成与本报表一模一样的图，也可以拿去其它分析软件做更进一步的分析。这些数据保存在Reports/Sheets目录中。\n\n    \n\n")
 
-        C_data_url = "\n\n[mC data sheet](Sheets/" + report_name + "_mC.xlsx" + ")"
-        CG_data_url = "\n\n[mCG data sheet](Sheets/" + report_name + "_mCG.xlsx" + ")"
-        sequence_url = "\n\n[Sequence info sheet](Sheets/" + report_name + "_sequence.xlsx" +")"
-
-
-
-
-
-        md = [title, description, sep,
-              CG_heat_map_title, CG_heat_map_description, CG_heat_map_md, sep,
-              peak_map_title, peak_map_description, CG_peak_map_md, C_peak_map_md, sep,
-              data_title, data_description, C_data_url, CG_data_url, sequence_url]
 
-        h5 = markdown.markdown("".join(md), extensions=["tables"], encoding="utf-8")
+        stats_title = "## Run statistics"
+        stats_description = (
+                    "\nTime spent on each stage for this report, from parsing the sequencing files to writing the figures. CPU time of the worker processes is summed over all processes, and reused or cached results do not appear.\n\n" +
+                    "生成本报告各环节的耗时 (从解析测序文件到画完图)。多进程时子进程的 CPU 时间为各进程之和，复用或缓存的结果不计入。\n\n")
 
-        # print(h5)
+        # 边画图边写报告，图片画好就写出 (FigureRenderer 的图会被下一张复用)
         report_path = save_path + "Reports/" + report_name + ".html"
-        with open(report_path, "w",encoding="utf-8") as f:
-            f.write("""<meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>\n\n""" + h5)
+        assets_dir = None if assets == "inline" else save_path + "Reports/assets"
+        with ReportWriter(report_path, assets_dir, "png" if assets == "inline" else assets) as writer:
+            def images(figs):
+                with stage("render"):
+                    for fig in figs:
+                        writer.image(fig)
+
+            writer.markdown(title + description)
+            writer.rule()
+
+            # 大矩阵时热图可能分成多页
+            writer.markdown(CG_heat_map_title + CG_heat_map_description)
+            images(self.heatMapPages(CG_peak, add_locs=add_locs, exc_locs=exc_locs,
+                                     title="Methalation status of each sequencing samples",
+                                     rows=sanger_names, cluster=cluster_rows))
+            writer.rule()
+
+            if self.fractions is not None:
+                writer.markdown(quant_title + quant_description)
+                images(self.heatMapPages(CG_peak, add_locs=add_locs, exc_locs=exc_locs,
+                                         title="C/(C+T) of each sequencing samples", rows=sanger_names,
+                                         quantitative=True, cluster=cluster_rows))
+                writer.rule()
+
+            writer.markdown(peak_map_title + peak_map_description)
+            # plotPeakMap 的图会被下一张复用，画一张写一张
+            images(self.plotPeakMap(*args) for args in ((CG_peak, "Methalation state of CG"),
+                                                        (C_peak, "Methalation state of C")))
+            writer.rule()
+
+            if qc_section:
+                writer.markdown("".join(qc_section))
+                writer.rule()
+
+            writer.markdown(data_title + data_description + "".join(data_urls))
+
+            if stats_since is not None:
+                writer.rule()
+                writer.markdown(stats_title + stats_description + stageTable(recorder().since(stats_since)))
+        self.outputs += [report_path] + writer.files
         return report_path
 
 
@@ -1,40 +1,58 @@
+import os, json, threading
+# 报告图片在后台线程里生成，不能用 Qt 后端
+os.environ["MPLBACKEND"] = "Agg"
 from PyQt5 import QtCore
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
 from PyQt5.QtWidgets import QMainWindow, QApplication, QTableWidgetItem, QFileDialog, QMessageBox
-import pandas as pd
-import os, requests, json
-from Bio import SeqIO
 
 from gui import Ui_MainWindow
 
-from Analyser import SangerBaseCall, BSReport
-
-def getLyric():
-    try:
-        url2 = 'https://v1.jinrishici.com/all'
-        lyric = requests.get(url2, timeout=1).json()
-        content = lyric['content']
-        try:
-            origin = lyric['origin']
-        except:
-            origin = "Unknown"
+from Analyser import AnalysisRow, BatchEngine, __version__, parseLocations, sangerName
+from cache import AnalysisCache
+from manifest import RowManifest
+from sheets import DEFAULT_FORMATS
+from store import ResultStore
+from lyric import getLyric, offlineMode, prefetch as prefetchLyrics
+
+
+class AnalysisWorker(QThread):
+    """在后台线程里跑 BatchEngine，界面通过信号更新"""
+    fileProgress = pyqtSignal(int, int, str)  # 已完成文件数, 文件总数, 测序文件
+    rowDone = pyqtSignal(int, str)  # 表格行号, 报告路径
+
+    def __init__(self, engine, rows, table_rows, save_path, manifest=None, sheet_formats=DEFAULT_FORMATS,
+                 parent=None):
+        super(AnalysisWorker, self).__init__(parent)
+        self.engine = engine
+        self.manifest = manifest
+        self.sheet_formats = sheet_formats
+        self.rows = rows
+        self.table_rows = table_rows
+        self.save_path = save_path
+        self.error = None
+
+    def run(self):
         try:
-            author = lyric['author']
-        except:
-            author = "Unknown"
+            for index, report_path in self.engine.analyse(self.rows, save_path=self.save_path,
+                                                          progress=self.fileProgress.emit,
+                                                          run_label=self.save_path, manifest=self.manifest,
+                                                          sheet_formats=self.sheet_formats):
+                self.rowDone.emit(self.table_rows[index], report_path)
+        except Exception as e:
+            self.error = str(e)
 
+    def cancel(self):
+        self.engine.cancel()
 
-        output = content + "\n\t\t\t" + "——《" + origin + "》\t" + author
-        return output
-    except Exception as e:
-        output = "BS-Seq Analyser" + "\n\t\t\t" + "——Written by M.Q. at ShanghaiTech University"
-        return output
 
 class MyMainWin(QMainWindow, Ui_MainWindow):
+    updateFound = pyqtSignal(str)
+
     def __init__(self, parent = None):
         super(MyMainWin, self).__init__(parent)
 
         self.setupUi(self)
-        self.version = "1.0.1"
+        self.version = __version__
 
         # 表格标题读取
         col_count = self.tableWidget.columnCount()
@@ -64,19 +82,29 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
 
         self.tableWidget.clicked.connect(self.disableAutoFill)
 
-        self.pushButton_start.clicked.connect(self.annalyse)
+        self.pushButton_start.clicked.connect(self.startOrCancel)
+        self.worker = None
 
-        self.checkUpdate()
+        # 窗口显示之后再在后台检查更新、预取诗词，离线时也不会卡住启动
+        self.updateFound.connect(self.askUpdate)
+        QTimer.singleShot(0, self.checkUpdate)
+        QTimer.singleShot(0, prefetchLyrics)
 
 
     def checkUpdate(self):
-        """使用requests模块和GitHub api获取最新版本"""
+        """在后台线程里获取最新版本，有新版本时通过 updateFound 信号回到界面线程询问"""
+        if offlineMode():
+            return
+        threading.Thread(target=self.fetchLatestRelease, daemon=True).start()
 
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'}
-        latestInfo = requests.get("https://gitee.com/api/v5/repos/MasterChiefm/BS-Analyser.py/releases/latest", timeout=2,  headers= headers)
-        # print(latestInfo)
+    def fetchLatestRelease(self):
+        """使用requests模块和GitHub api获取最新版本"""
         try:
+            import requests
+
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36'}
+            latestInfo = requests.get("https://gitee.com/api/v5/repos/MasterChiefm/BS-Analyser.py/releases/latest", timeout=2,  headers= headers)
             info = latestInfo.text
             info = json.loads(info)
             # print(info)
@@ -85,20 +113,17 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
             #print(latestVersion)
 
             if latestVersion == self.version:
-                # QMessageBox.about(self, "更新", "已经是最新")
                 return
-            else:
-                msg = latestVersion + "\n" + releaseInfo
-                # QMessageBox.about(self,"更新",msg)
-                answer = QMessageBox.question(self,"New BEAR version found", msg + "\n\n Update now?")
-                if answer == QMessageBox.Yes:
-                    os.startfile("https://gitee.com/MasterChiefm/BS-Analyser.py/releases/latest")
-                else:
-                    return
+            self.updateFound.emit(latestVersion + "\n" + releaseInfo)
         except Exception as e:
             # QMessageBox.about(self,"网络错误","无法连接到GitHub服务器")
             print(e)
 
+    def askUpdate(self, msg):
+        answer = QMessageBox.question(self,"New BEAR version found", msg + "\n\n Update now?")
+        if answer == QMessageBox.Yes:
+            os.startfile("https://gitee.com/MasterChiefm/BS-Analyser.py/releases/latest")
+
     def annalyse(self):
 
         self.label_lyric.setText("❤❤❤❤❤❤   Analyzing... Please waite!   ❤❤❤❤❤❤")
@@ -110,9 +135,14 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
             self.label_lyric.setText(lyric)
             return
 
+        # 按文件内容缓存解析和比对结果，只改了作图参数时重跑很快
+        cache = AnalysisCache()
+
         table = self.tableWidget
         # sheet = pd.DataFrame(columns=self.col_names)
 
+        rows = []
+        table_rows = []
         for row in range(table.rowCount()):
             try:
                 name = table.item(row, 0).text().strip()
@@ -123,42 +153,91 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
                 continue
 
             try:
-                add_locs = []
-                add_locs_text = table.item(row,self.col_name_locations["Additional locations"]).text()
-                add_locs_text = add_locs_text.replace("，",",")
-                for loc in add_locs_text.split(","):
-                    add_locs.append(int(loc))
+                add_locs = parseLocations(table.item(row,self.col_name_locations["Additional locations"]).text())
             except:
                 add_locs = []
 
             try:
-                exc_locs = []
-                exc_locs_text = table.item(row,self.col_name_locations["Excluded locations"]).text()
-                exc_locs_text = exc_locs_text.replace("，",",")
-                for loc in exc_locs_text.split(","):
-                    exc_locs.append(int(loc))
+                exc_locs = parseLocations(table.item(row,self.col_name_locations["Excluded locations"]).text())
             except:
                 exc_locs = []
 
-
-            sub_result = [ref_sequence]
             for sanger_file in sanger_files:
-                sanger_name = str(os.path.basename(sanger_file)).split(self.lineEdit_sep.text())[0]
-                sanger_names.append(sanger_name)
-                seq = SangerBaseCall(sanger_file)
-                alignment = seq.locTartet(ref_sequence)[0]
-                sub_result.append(alignment)
-
-            report = BSReport(sub_result)
-            report_path = report.generateReport(ref_seq=ref_sequence,sanger_names=sanger_names,add_locs=add_locs,exc_locs=exc_locs,report_name=name,save_path=save_path)
-            self.tableWidget.setItem(row,self.col_name_locations["Report"],QTableWidgetItem(report_path))
-
-        self.label_lyric.setText(lyric)
-        QMessageBox.about(self,"Done","Analysis complete!")
-
-
-
-
+                sanger_names.append(sangerName(sanger_file, self.lineEdit_sep.text()))
+
+            rows.append(AnalysisRow(name, ref_sequence, sanger_files, sanger_names, add_locs, exc_locs))
+            table_rows.append(row)
+
+        # 各行的测序文件在进程池中并行比对，同一个文件出现在多行时只比对一次
+        # 整个过程在后台线程里进行，界面不会卡住
+        # 每次分析的位点判断都追加到 ~/.bs_analyser/results.sqlite，可以跨批次查询
+        engine = BatchEngine(cache=cache, store=ResultStore())
+        self.rows_done = 0
+        self.rows_total = len(rows)
+        # 已完成各行的耗时摘要，显示在进度下面
+        self.stats_text = ""
+        # 输入和选项都没变的行跳过，不重新比对、出报告
+        manifest = RowManifest(save_path, __version__)
+        # 数据表默认只写 csv，勾选后再写一份 xlsx (openpyxl 很慢)
+        sheet_formats = DEFAULT_FORMATS + ("xlsx",) if self.checkBox_excel_sheets.isChecked() else DEFAULT_FORMATS
+        self.worker = AnalysisWorker(engine, rows, table_rows, save_path, manifest, sheet_formats, self)
+        self.worker.fileProgress.connect(self.showFileProgress)
+        self.worker.rowDone.connect(self.showRowDone)
+        self.worker.finished.connect(lambda: self.analysisFinished(cache, lyric))
+        self.start_text = self.pushButton_start.text()
+        self.pushButton_start.setText("取消分析")
+        self.worker.start()
+
+    def closeEvent(self, event):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.worker.wait()
+        super(MyMainWin, self).closeEvent(event)
+
+    def startOrCancel(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.cancel()
+            self.pushButton_start.setEnabled(False)
+            self.label_lyric.setText("Cancelling... waiting for running alignments to finish")
+        else:
+            self.annalyse()
+
+    def showFileProgress(self, finished, total, sanger_file):
+        text = "Analyzing... %d/%d files, %d/%d rows done\n%s" % (finished, total, self.rows_done, self.rows_total,
+                                                                   os.path.basename(sanger_file))
+        if self.stats_text:
+            text += "\n" + self.stats_text
+        self.label_lyric.setText(text)
+
+    def showRowDone(self, row, report_path):
+        self.rows_done += 1
+        if self.worker is not None:
+            self.stats_text = self.worker.engine.statsText()
+        self.tableWidget.setItem(row,self.col_name_locations["Report"],QTableWidgetItem(report_path))
+
+    def analysisFinished(self, cache, lyric):
+        engine = self.worker.engine
+        error = self.worker.error
+        cache.flush()
+        engine.store.close()
+        if not error and not engine.cancelled:
+            # 删除表格中已经没有的行的报告和数据表
+            pruned = self.worker.manifest.prune([row.name for row in self.worker.rows])
+            if pruned:
+                print("removed the outputs of %d rows no longer in the table" % pruned)
+        stats_text = engine.statsText()
+        print(engine.summary())
+        print(stats_text)
+        self.pushButton_start.setText(self.start_text)
+        self.pushButton_start.setEnabled(True)
+        self.label_lyric.setText(lyric + "\n" + stats_text if stats_text else lyric)
+        self.worker = None
+        if error:
+            QMessageBox.about(self,"ERROR",error)
+        elif engine.cancelled:
+            QMessageBox.about(self,"Cancelled","Analysis cancelled, %d/%d rows done." % (self.rows_done, self.rows_total))
+        else:
+            QMessageBox.about(self,"Done","Analysis complete!\n\n" + stats_text)
 
     def disableAutoFill(self):
         self.checkBox_auto_fill_col.setChecked(False)
@@ -177,6 +256,8 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
             file_path = file.replace("\n", "")
             if os.path.isfile(file_path):
                 if "dna" in file_path.lower()[-4:]:
+                    from Bio import SeqIO
+
                     file_name = os.path.basename(file_path)
                     sequence = str(SeqIO.read(file_path, "snapgene").seq).upper()
                     sample_name = file_name
@@ -259,6 +340,8 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
         else:
             file_path, type = QFileDialog.getSaveFileName(self, "存", "", "excel(*.xlsx)")
 
+        import pandas as pd
+
         sheet = pd.DataFrame(columns = self.col_names)
         if file_path:
             pass
@@ -286,6 +369,8 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
         else:
             return
 
+        import pandas as pd
+
         sheet = pd.read_excel(file_path, index_col=0)
         # count = self.tableWidget.rowCount()
         self.tableWidget.clearContents()
@@ -371,7 +456,10 @@ class MyMainWin(QMainWindow, Ui_MainWindow):
 
 if __name__ == "__main__":
     import sys
+    from multiprocessing import freeze_support
 
+    # 打包成 exe 后进程池的子进程需要
+    freeze_support()
     # trans = QtCore.QTranslator()
     # trans.load("./en")
 
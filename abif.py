@@ -0,0 +1,111 @@
+"""ABIF(.ab1) 测序文件的精简读取器
+
+SeqIO.read(..., "abi") 会把所有目录项都解码到 annotations["abif_raw"] 里，
+而分析只需要 PBAS/PLOC/DATA9-12/PCON 这几个标签。这里把文件做内存映射，
+只遍历一次目录，需要哪个标签再用 np.frombuffer 直接在映射上生成数组（不复制）。
+"""
+import mmap
+import struct
+
+import numpy as np
+
+# 目录项：name, number, elementtype, elementsize, numelements, datasize, dataoffset, datahandle
+_DIR_ENTRY = struct.Struct(">4sIHHIIII")
+
+# ABIF 元素类型 -> NumPy 数据类型（大端）
+_DTYPES = {
+    1: ">u1",  # byte
+    2: ">u1",  # char
+    3: ">u2",  # word
+    4: ">i2",  # short
+    5: ">i4",  # long
+    7: ">f4",  # float
+    8: ">f8",  # double
+}
+_PSTRING = 18
+_CSTRING = 19
+
+
+class ABIFError(ValueError):
+    pass
+
+
+class ABIFReader:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "rb") as f:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            raise ABIFError("%s: empty file" % path) from e
+
+        if self._buffer[:4] != b"ABIF":
+            raise ABIFError("%s: not an ABIF file" % path)
+        self.version = struct.unpack_from(">H", self._buffer, 4)[0]
+
+        # 根目录项位于第 6 字节，指向真正的目录
+        root = _DIR_ENTRY.unpack_from(self._buffer, 6)
+        dir_count, dir_offset = root[4], root[6]
+        if dir_offset + dir_count * _DIR_ENTRY.size > len(self._buffer):
+            raise ABIFError("%s: truncated directory" % path)
+
+        # "PBAS2" -> (elementtype, elementsize, numelements, datasize, dataoffset)
+        self.entries = {}
+        for i in range(dir_count):
+            entry_offset = dir_offset + i * _DIR_ENTRY.size
+            name, number, etype, esize, count, size, offset, _ = _DIR_ENTRY.unpack_from(self._buffer, entry_offset)
+            if size <= 4:
+                # 数据不超过4字节时直接存放在 dataoffset 字段里
+                offset = entry_offset + 20
+            key = name.decode("ascii", "replace") + str(number)
+            self.entries[key] = (etype, esize, count, size, offset)
+
+    def __contains__(self, tag):
+        return tag in self.entries
+
+    def __getitem__(self, tag):
+        return self.get(tag)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def get(self, tag):
+        """返回标签对应的数组；字符串类型返回 bytes"""
+        try:
+            etype, esize, count, size, offset = self.entries[tag]
+        except KeyError:
+            raise ABIFError("%s: tag %s not found" % (self.path, tag)) from None
+        if offset + size > len(self._buffer):
+            raise ABIFError("%s: tag %s points outside the file" % (self.path, tag))
+
+        if etype == _PSTRING:
+            return bytes(self._buffer[offset + 1:offset + size])
+        if etype == _CSTRING:
+            return bytes(self._buffer[offset:offset + size]).rstrip(b"\0")
+
+        dtype = np.dtype(_DTYPES.get(etype, ">u1"))
+        return np.frombuffer(self._buffer, dtype=dtype, count=size // dtype.itemsize, offset=offset)
+
+    def read(self, tags):
+        """一次取出多个标签，缺失的标签不出现在结果里"""
+        return {tag: self.get(tag) for tag in tags if tag in self.entries}
+
+    def first(self, *tags):
+        """按顺序返回第一个存在的标签，例如 first("PBAS2", "PBAS1")"""
+        for tag in tags:
+            if tag in self.entries:
+                return self.get(tag)
+        raise ABIFError("%s: none of %s found" % (self.path, ", ".join(tags)))
+
+    def close(self):
+        try:
+            self._buffer.close()
+        except BufferError:
+            # 仍有数组引用这块映射，交给垃圾回收
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,355 @@
+"""SangerBaseCall.locTartet 使用的比对后端
+
+所有后端都返回 AlignmentHit，其前三项与旧版 pairwise2 实现的结果格式相同
+(match_seq, location_start, location_end)：match_seq 是测序序列在局部比对区域内带空位的片段，
+location_start/location_end 是该区域在 pairwise2 式完整比对串中的起止位置。
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# 碱基 -> 0..3，其余字符(N 等)为 255
+_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _base in enumerate(b"ACGT"):
+    _CODES[_base] = _i
+    _CODES[ord(chr(_base).lower())] = _i
+
+
+# 含 IUPAC 简并碱基的互补表，与 Bio.Seq.reverse_complement 一致
+_COMPLEMENT = str.maketrans("ACGTUMRWSYKVHDBNacgtumrwsykvhdbn", "TGCAAKYWSRMBDHVNtgcaakywsrmbdhvn")
+
+
+@lru_cache(maxsize=256)
+def reverseComplement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+
+class AlignmentHit(namedtuple("AlignmentHit", "match_seq location_start location_end strand "
+                                               "target_start query_start target_match")):
+    """locate 的完整结果，前三项即 locTartet 的返回值。
+
+    strand 为 1 (与参考序列同向) 或 -1 (与其反向互补同向)；target_start/query_start 为
+    比对区域在该链参考序列和测序序列中的起点；target_match 为参考序列一侧带空位的片段。
+    """
+
+    @classmethod
+    def empty(cls):
+        return cls("", 0, 0, 1, 0, 0, "")
+
+    def referenceToRead(self, ref_length):
+        """参考序列(输入的那条链)每个位置对应的测序碱基序号，没有比对上或对着空位的为 -1"""
+        mapping = np.full(ref_length, -1, dtype=np.int64)
+        target = np.frombuffer(self.target_match.encode("ascii"), dtype=np.uint8) != ord("-")
+        query = np.frombuffer(self.match_seq.encode("ascii"), dtype=np.uint8) != ord("-")
+        if len(target) != len(query) or not len(target):
+            return mapping
+        target_pos = self.target_start + np.cumsum(target) - 1
+        query_pos = self.query_start + np.cumsum(query) - 1
+        both = target & query
+        target_pos, query_pos = target_pos[both], query_pos[both]
+        if self.strand == -1:
+            target_pos = ref_length - 1 - target_pos
+        inside = (target_pos >= 0) & (target_pos < ref_length)
+        mapping[target_pos[inside]] = query_pos[inside]
+        return mapping
+
+    def alignedRead(self, ref_length):
+        """按参考序列(输入的那条链)坐标排好的测序碱基，长度为 ref_length，没有覆盖的位置为 "-"。
+        与反向互补链比对上的测序结果取互补碱基，因此总是与输入的参考序列同向"""
+        read = np.full(ref_length, ord("-"), dtype=np.uint8)
+        target = np.frombuffer(self.target_match.encode("ascii"), dtype=np.uint8) != ord("-")
+        match_seq = self.match_seq.translate(_COMPLEMENT) if self.strand == -1 else self.match_seq
+        query = np.frombuffer(match_seq.encode("ascii"), dtype=np.uint8)
+        if len(target) == len(query) and len(target):
+            target_pos = self.target_start + np.cumsum(target)[target] - 1
+            if self.strand == -1:
+                target_pos = ref_length - 1 - target_pos
+            inside = (target_pos >= 0) & (target_pos < ref_length)
+            read[target_pos[inside]] = query[target][inside]
+        return read.tobytes().decode("ascii")
+
+    def offsetQuery(self, offset):
+        """只拿测序序列从 offset 开始的一段去比对时，把结果换算回完整测序序列上的坐标"""
+        if not self.match_seq or not offset:
+            return self
+        query_start = self.query_start + offset
+        location_start = max(self.target_start, query_start)
+        return self._replace(location_start=location_start,
+                             location_end=location_start + self.location_end - self.location_start,
+                             query_start=query_start)
+
+
+class Aligner:
+    name = ""
+
+    def __init__(self, match=2, mismatch=-.1, open_gap=-4, extend_gap=-2):
+        self.match = match
+        self.mismatch = mismatch
+        self.open_gap = open_gap
+        self.extend_gap = extend_gap
+
+    @property
+    def params(self):
+        """决定比对结果的全部参数，用作缓存键"""
+        return (self.name, self.match, self.mismatch, self.open_gap, self.extend_gap)
+
+    def locate(self, target_seq, query_seq, max_mismatch=10):
+        raise NotImplementedError
+
+
+class Pairwise2Aligner(Aligner):
+    """旧版实现：两条链各跑一次完整的 pairwise2 局部比对，用于核对结果"""
+    name = "pairwise2"
+
+    def locate(self, target_seq, query_seq, max_mismatch=10):
+        from Bio import pairwise2
+
+        target_is_reversed = False
+        scoring = (self.match, self.mismatch, self.open_gap, self.extend_gap)
+        alignment_1 = pairwise2.align.localms(target_seq, query_seq, *scoring, one_alignment_only=True)
+        target_seq_reversed = reverseComplement(target_seq)
+        alignment_2 = pairwise2.align.localms(target_seq_reversed, query_seq, *scoring, one_alignment_only=True)
+        try:
+            alignment_1[0]
+        except:
+            alignment_1 = [[0, 0, 0]]
+        try:
+            alignment_2[0]
+        except:
+            alignment_2 = [[0, 0, 0]]
+
+        if alignment_2[0][2] > alignment_1[0][2]:
+            alignment = alignment_2
+            strand = -1
+        else:
+            alignment = alignment_1
+            strand = 1
+
+        if target_is_reversed:
+            location_start = alignment[0][4]
+            location_end = alignment[0][3]
+        else:
+            location_start = alignment[0][3]
+            location_end = alignment[0][4]
+            match_seq = str(alignment[0][1][location_start:location_end]).upper()
+
+        seqA, seqB = alignment[0][0], alignment[0][1]
+        return AlignmentHit(match_seq, location_start, location_end, strand,
+                            len(seqA[:location_start].replace("-", "")), len(seqB[:location_start].replace("-", "")),
+                            str(seqA[location_start:location_end]).upper())
+
+
+def bisulfiteConvert(seq, strand):
+    """亚硫酸氢盐转换后的三字母序列：正链 C->T，反链(反向互补后) G->A"""
+    if strand == 1:
+        return seq.replace("C", "T")
+    return seq.replace("G", "A")
+
+
+class BisulfiteReference:
+    """参考序列两条链的原始和转换版本，每条参考序列只算一次"""
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.reversed = reverseComplement(seq)
+        self.forward_converted = bisulfiteConvert(seq, 1)
+        self.reverse_converted = bisulfiteConvert(self.reversed, -1)
+
+    def strand(self, strand, converted=False):
+        if strand == 1:
+            return self.forward_converted if converted else self.seq
+        return self.reverse_converted if converted else self.reversed
+
+
+@lru_cache(maxsize=32)
+def bisulfiteReference(seq):
+    return BisulfiteReference(seq)
+
+
+def _restoreBases(gapped_seq, original_seq):
+    """把带空位的转换序列中的碱基换回原始碱基，空位保持不变"""
+    gapped = np.frombuffer(gapped_seq.encode("ascii"), dtype=np.uint8).copy()
+    gapped[gapped != ord("-")] = np.frombuffer(original_seq.encode("ascii"), dtype=np.uint8)
+    return gapped.tobytes().decode("ascii")
+
+
+class FastAligner(Aligner):
+    """Bio.Align.PairwiseAligner (C 实现)。先只算两条链的分数选出链，再只对胜出的链回溯。
+
+    three_letter=True 时在转换后的三字母序列上打分(测序序列与参考序列同样转换)，
+    未甲基化 C 变成的 T 不再算错配；返回的 match_seq 仍是原始碱基。
+    """
+    name = "fast"
+
+    def __init__(self, match=2, mismatch=-.1, open_gap=-4, extend_gap=-2, three_letter=False):
+        super().__init__(match, mismatch, open_gap, extend_gap)
+        self.three_letter = three_letter
+        self._aligner = self._makeAligner()
+
+    def _makeAligner(self):
+        from Bio.Align import PairwiseAligner
+
+        return PairwiseAligner(mode="local", match_score=self.match, mismatch_score=self.mismatch,
+                               open_gap_score=self.open_gap, extend_gap_score=self.extend_gap)
+
+    def __getstate__(self):
+        # PairwiseAligner 不能 pickle，传给子进程后重新创建
+        state = self.__dict__.copy()
+        del state["_aligner"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._aligner = self._makeAligner()
+
+    @property
+    def params(self):
+        return super().params + (self.three_letter,)
+
+    def _strandPair(self, reference, query_seq, strand):
+        """某条链上实际参与打分的 (参考序列, 测序序列)"""
+        if self.three_letter:
+            return reference.strand(strand, converted=True), bisulfiteConvert(query_seq, strand)
+        return reference.strand(strand), query_seq
+
+    def _traceback(self, reference, strand, target_seq, query_seq, original_query, target_offset=0):
+        """对一条链做回溯，target_offset 为传入片段在该链参考序列中的起点"""
+        alignment = self._aligner.align(target_seq, query_seq)[0]
+        coordinates = alignment.coordinates
+        target_start, target_end = int(coordinates[0, 0]) + target_offset, int(coordinates[0, -1]) + target_offset
+        query_start, query_end = int(coordinates[1, 0]), int(coordinates[1, -1])
+        match_seq = _restoreBases(alignment[1], original_query[query_start:query_end]).upper()
+        target_match = _restoreBases(alignment[0], reference.strand(strand)[target_start:target_end]).upper()
+
+        # pairwise2 把两条序列的前端右对齐，局部比对区域从两者中较长的前缀之后开始
+        location_start = max(target_start, query_start)
+        return AlignmentHit(match_seq, location_start, location_start + len(match_seq), strand,
+                            target_start, query_start, target_match)
+
+    def locate(self, target_seq, query_seq, max_mismatch=10):
+        reference = bisulfiteReference(target_seq)
+        forward = self._strandPair(reference, query_seq, 1)
+        reverse = self._strandPair(reference, query_seq, -1)
+        forward_score = self._aligner.score(*forward)
+        reverse_score = self._aligner.score(*reverse)
+        # 打平时与旧版一致取正链
+        strand, score = (-1, reverse_score) if reverse_score > forward_score else (1, forward_score)
+        if score <= 0:
+            return AlignmentHit.empty()
+        return self._traceback(reference, strand, *(reverse if strand == -1 else forward), query_seq)
+
+
+def kmerCodes(seq, k):
+    """序列中每个 k-mer 的整数编码及其起点，含非 ACGT 字符的 k-mer 被丢弃"""
+    codes = _CODES[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+    if len(codes) < k:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+    valid = (windows != 255).all(axis=1)
+    weights = 4 ** np.arange(k - 1, -1, -1, dtype=np.int64)
+    kmers = windows[valid].astype(np.int64) @ weights
+    return kmers, np.flatnonzero(valid)
+
+
+@lru_cache(maxsize=32)
+def kmerIndex(seq, k):
+    """参考序列的 k-mer 索引：排好序的编码和对应位置。同一行的所有测序文件共用一份"""
+    kmers, positions = kmerCodes(seq, k)
+    order = np.argsort(kmers, kind="stable")
+    return kmers[order], positions[order]
+
+
+class SeededAligner(FastAligner):
+    """先用 k-mer 种子投票确定链和对角线，再把读段与参考序列上沿该对角线覆盖的窗口做局部比对。
+
+    种子取自转换后的三字母序列(见 BisulfiteReference)，未甲基化的 C 不会打断种子。
+    窗口为 [对角线 - max_mismatch, 对角线 + 读段长度 + max_mismatch)，即 max_mismatch 只是窗口两侧的余量，
+    不是带宽；它同时是投票时合并相邻对角线的范围(容纳插入缺失)。窗口内仍是完整的动态规划，耗时与 读段长度 x 窗口长度 成正比，
+    省下的只是参考序列上窗口以外的部分，参考序列远长于读段时才有明显效果。
+    票数不足 min_votes 时退回完整比对。
+    """
+    name = "seeded"
+
+    def __init__(self, match=2, mismatch=-.1, open_gap=-4, extend_gap=-2, three_letter=False,
+                 k=14, min_votes=3, max_occurrence=8):
+        super().__init__(match, mismatch, open_gap, extend_gap, three_letter)
+        self.k = k
+        self.min_votes = min_votes
+        self.max_occurrence = max_occurrence
+
+    @property
+    def params(self):
+        return super().params + (self.k, self.min_votes, self.max_occurrence)
+
+    def vote(self, target_seq, query_seq, band):
+        """返回 (票数, 对角线)，对角线 = 参考位置 - 测序位置"""
+        ref_kmers, ref_positions = kmerIndex(target_seq, self.k)
+        kmers, positions = kmerCodes(query_seq, self.k)
+        left = np.searchsorted(ref_kmers, kmers, side="left")
+        counts = np.searchsorted(ref_kmers, kmers, side="right") - left
+        # 高度重复的 k-mer 没有定位信息
+        keep = (counts > 0) & (counts <= self.max_occurrence)
+        left, counts, positions = left[keep], counts[keep], positions[keep]
+        if not len(counts):
+            return 0, 0
+
+        # 把每个读段 k-mer 展开成它在参考序列中的全部命中
+        total = int(counts.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        diagonals = ref_positions[np.repeat(left, counts) + offsets] - np.repeat(positions, counts)
+
+        # 相邻 band 以内的对角线合并计票，容纳插入缺失
+        lowest = diagonals.min()
+        votes = np.cumsum(np.bincount(diagonals - lowest))
+        votes = np.concatenate(([0], votes))
+        index = np.arange(len(votes) - 1)
+        votes = votes[np.minimum(index + band + 1, len(votes) - 1)] - votes[np.maximum(index - band, 0)]
+        best = int(votes.argmax())
+        return int(votes[best]), best + int(lowest)
+
+    def locate(self, target_seq, query_seq, max_mismatch=10):
+        pad = max(int(max_mismatch), 1)
+        reference = bisulfiteReference(target_seq)
+        forward = self.vote(reference.forward_converted, bisulfiteConvert(query_seq, 1), pad)
+        reverse = self.vote(reference.reverse_converted, bisulfiteConvert(query_seq, -1), pad)
+        strand, (votes, diagonal) = (-1, reverse) if reverse[0] > forward[0] else (1, forward)
+
+        # 参考序列上只取读段沿最佳对角线覆盖的区域，两侧各留 pad；窗口内不再限制带宽
+        strand_seq, strand_query = self._strandPair(reference, query_seq, strand)
+        window_start = max(diagonal - pad, 0)
+        window_end = min(diagonal + len(query_seq) + pad, len(strand_seq))
+        if votes < self.min_votes or window_end <= window_start:
+            return super().locate(target_seq, query_seq, max_mismatch)
+
+        window = strand_seq[window_start:window_end]
+        if self._aligner.score(window, strand_query) <= 0:
+            return AlignmentHit.empty()
+        return self._traceback(reference, strand, window, strand_query, query_seq, target_offset=window_start)
+
+
+class BisulfiteAligner(SeededAligner):
+    """种子 + 窗口比对，并使用三字母打分，适合转换程度高的扩增子"""
+    name = "bisulfite"
+
+    def __init__(self, match=2, mismatch=-.1, open_gap=-4, extend_gap=-2, three_letter=True, **kwargs):
+        super().__init__(match, mismatch, open_gap, extend_gap, three_letter, **kwargs)
+
+
+ALIGNERS = {
+    Pairwise2Aligner.name: Pairwise2Aligner,
+    FastAligner.name: FastAligner,
+    SeededAligner.name: SeededAligner,
+    BisulfiteAligner.name: BisulfiteAligner,
+}
+DEFAULT_ALIGNER = FastAligner.name
+
+
+def getAligner(aligner=DEFAULT_ALIGNER, **kwargs):
+    """按名字创建比对后端；传入的已经是 Aligner 时原样返回"""
+    if isinstance(aligner, Aligner):
+        return aligner
+    try:
+        return ALIGNERS[aligner](**kwargs)
+    except KeyError:
+        raise ValueError("Unknown aligner: " + str(aligner) + ", choose from " + ", ".join(ALIGNERS)) from None
@@ -0,0 +1,170 @@
+"""生成模拟的亚硫酸氢盐测序 .ab1 文件，用于基准测试，不需要真实数据
+
+    python benchmarks/abifgen.py out_dir --reads 8 --length 400 [--conversion 0.98] [--methylation 0.7]
+                                 [--noise 0.05] [--reverse 0.5] [--seed 0]
+
+写出 ref.txt (参考序列) 和 read_<i>_x.ab1。每条测序结果：
+- 参考序列两端加上随机碱基，非 CpG 的 C 以 conversion 的概率转换成 T，
+  CpG 的 C 按位点的甲基化比例 (各位点在 methylation 附近随机) 在 C、T 两个通道上同时出峰
+- 信号为高斯峰加上 noise (相对峰高) 的随机噪音，峰高逐渐衰减；两端质量值 (PCON) 较低，便于测试修剪
+- 以 reverse 的概率为反向互补链
+文件包含 PBAS1/2、PLOC1/2、PCON1/2、DATA9-12、SMPL1 标签，ABIFReader 和 Biopython 都能读取。
+"""
+import argparse
+import os
+import struct
+import sys
+
+import numpy as np
+
+BASES = "ACGT"
+# DATA9-12 对应的碱基，与 qc.CHANNELS 一致
+CHANNELS = "GATC"
+PEAK_SPACING = 12
+PEAK_HEIGHT = 1000.0
+PEAK_WIDTH = 2.0
+
+
+def randomReference(length, rng, cpg_rate=0.06):
+    """随机参考序列，额外插入一些 CpG，保证有足够的甲基化位点"""
+    seq = np.array(list(BASES))[rng.integers(0, 4, length)]
+    for i in np.flatnonzero(rng.random(length - 1) < cpg_rate):
+        seq[i], seq[i + 1] = "C", "G"
+    return "".join(seq)
+
+
+def reverseComplement(seq):
+    return seq[::-1].translate(str.maketrans("ACGTN", "TGCAN"))
+
+
+def bisulfiteRead(ref, rng, conversion=0.98, methylation=0.7, flank=60):
+    """返回 (碱基序列, 每个位置 C 通道所占比例)。比例只在参考序列的 C 上小于 1：
+    非 CpG 的 C 为 1 - conversion 附近，CpG 的 C 为该位点的甲基化比例"""
+    ref = ref.upper()
+    ref_array = np.frombuffer(ref.encode("ascii"), dtype=np.uint8)
+    is_c = ref_array == ord("C")
+    is_cpg = is_c & np.append(ref_array[1:] == ord("G"), False)
+    # 各位点的 C 比例
+    c_fraction = np.where(is_cpg, np.clip(rng.normal(methylation, 0.15, len(ref)), 0, 1),
+                          np.where(rng.random(len(ref)) < conversion, 0.0, 1.0))
+    c_fraction = np.where(is_c, c_fraction, 1.0)
+    called = np.where(is_c & (c_fraction < 0.5), ord("T"), ref_array).astype(np.uint8)
+
+    left = rng.integers(0, 4, flank)
+    right = rng.integers(0, 4, flank)
+    flank_bases = np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)
+    seq = np.concatenate([flank_bases[left], called, flank_bases[right]]).tobytes().decode("ascii")
+    fractions = np.concatenate([np.ones(flank), c_fraction, np.ones(flank)])
+    return seq, fractions
+
+
+def traceSignals(seq, fractions, rng, noise=0.05, spacing=PEAK_SPACING):
+    """(4, N) 信号矩阵 (行顺序同 CHANNELS) 和峰值位置。C 比例小于 1 的位置在 T 通道上出对应高度的峰
+    (反向链为 G/A，由调用方传入已经互补好的 seq 和 fractions 时同样适用)"""
+    n = len(seq)
+    locations = np.arange(n, dtype=np.int64) * spacing + spacing
+    length = int(locations[-1] + spacing) if n else spacing
+    signals = np.abs(rng.normal(0, noise * PEAK_HEIGHT, (4, length)))
+    # 峰高沿读长缓慢衰减，并有随机起伏
+    heights = PEAK_HEIGHT * np.linspace(1.0, 0.5, n) * rng.uniform(0.7, 1.3, n)
+    x = np.arange(-4 * int(PEAK_WIDTH) - 1, 4 * int(PEAK_WIDTH) + 2)
+    shape = np.exp(-x ** 2 / (2 * PEAK_WIDTH ** 2))
+    partner = {"C": "T", "G": "A"}
+    for i, base in enumerate(seq):
+        window = locations[i] + x
+        keep = (window >= 0) & (window < length)
+        if base in partner or fractions[i] < 1:
+            # 混合峰：本身的碱基和转换后的碱基按比例分配
+            methylated = base if base in partner else {"T": "C", "A": "G"}[base]
+            share = fractions[i]
+            signals[CHANNELS.index(methylated), window[keep]] += heights[i] * share * shape[keep]
+            signals[CHANNELS.index(partner[methylated]), window[keep]] += heights[i] * (1 - share) * shape[keep]
+        elif base in CHANNELS:
+            signals[CHANNELS.index(base), window[keep]] += heights[i] * shape[keep]
+    return np.clip(signals, 0, 32767).astype(np.int16), locations
+
+
+def qualityValues(n, rng, noise=0.05):
+    """两端低、中间高的质量值，噪音越大整体越低"""
+    position = np.abs(np.arange(n) - n / 2) / max(n / 2, 1)
+    quality = 50 - 45 * position ** 4 - 100 * noise + rng.normal(0, 3, n)
+    return np.clip(quality, 2, 60).astype(np.uint8)
+
+
+def writeABIF(path, seq, locations, signals, qualities, sample="sample"):
+    """写出只含分析所需标签的 ABIF 文件"""
+    seq_bytes = seq.encode("ascii")
+    if len(locations) and max(locations[-1], len(signals[0])) > 32767:
+        raise ValueError("trace too long for 16-bit PLOC/DATA (%d bases)" % len(seq))
+    ploc = np.asarray(locations).astype(">i2").tobytes()
+    tags = [("PBAS", 1, 2, 1, seq_bytes), ("PBAS", 2, 2, 1, seq_bytes),
+            ("PLOC", 1, 4, 2, ploc), ("PLOC", 2, 4, 2, ploc),
+            ("PCON", 1, 2, 1, bytes(qualities)), ("PCON", 2, 2, 1, bytes(qualities))]
+    for number, channel in zip((9, 10, 11, 12), signals):
+        tags.append(("DATA", number, 4, 2, np.asarray(channel).astype(">i2").tobytes()))
+    name = sample.encode("ascii")[:255]
+    tags.append(("SMPL", 1, 18, 1, bytes([len(name)]) + name))
+
+    header_size = 128
+    body, entries = b"", []
+    for tag, number, etype, esize, data in tags:
+        if len(data) <= 4:
+            # 不超过 4 字节的数据直接放在 dataoffset 字段
+            entry = struct.pack(">4sIHHII", tag.encode("ascii"), number, etype, esize, len(data) // esize, len(data))
+            entries.append(entry + data.ljust(4, b"\0") + b"\0\0\0\0")
+        else:
+            entries.append(struct.pack(">4sIHHIIII", tag.encode("ascii"), number, etype, esize, len(data) // esize,
+                                       len(data), header_size + len(body), 0))
+            body += data
+    directory = b"".join(entries)
+    root = struct.pack(">4sIHHIIII", b"tdir", 1, 1023, 28, len(entries), len(directory), header_size + len(body), 0)
+    header = (b"ABIF" + struct.pack(">H", 101) + root).ljust(header_size, b"\0")
+    with open(path, "wb") as f:
+        f.write(header + body + directory)
+
+
+def makeTrace(path, ref, rng, conversion=0.98, methylation=0.7, noise=0.05, reverse=False, flank=60):
+    """为参考序列 ref 写一个模拟测序文件，返回测序序列"""
+    seq, fractions = bisulfiteRead(ref, rng, conversion, methylation, flank)
+    if reverse:
+        seq, fractions = reverseComplement(seq), fractions[::-1]
+    signals, locations = traceSignals(seq, fractions, rng, noise)
+    writeABIF(path, seq, locations, signals, qualityValues(len(seq), rng, noise),
+              os.path.basename(path).split("_")[0])
+    return seq
+
+
+def makeDataset(directory, reads=8, length=400, conversion=0.98, methylation=0.7, noise=0.05, reverse=0.5, seed=0):
+    """在 directory 下写出 ref.txt 和 reads 个测序文件，返回 (参考序列, 测序文件列表)"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    ref = randomReference(length, rng)
+    with open(os.path.join(directory, "ref.txt"), "w") as f:
+        f.write(ref)
+    files = []
+    for i in range(reads):
+        path = os.path.join(directory, "read%d_x.ab1" % i)
+        makeTrace(path, ref, rng, conversion, methylation, noise, reverse=rng.random() < reverse)
+        files.append(path)
+    return ref, files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory")
+    parser.add_argument("--reads", type=int, default=8)
+    parser.add_argument("--length", type=int, default=400, help="reference length")
+    parser.add_argument("--conversion", type=float, default=0.98, help="bisulfite conversion rate of non-CpG C")
+    parser.add_argument("--methylation", type=float, default=0.7, help="mean CpG methylation")
+    parser.add_argument("--noise", type=float, default=0.05, help="noise relative to peak height")
+    parser.add_argument("--reverse", type=float, default=0.5, help="fraction of reverse-strand reads")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    ref, files = makeDataset(args.directory, args.reads, args.length, args.conversion, args.methylation,
+                             args.noise, args.reverse, args.seed)
+    print("%d bp reference, %d traces in %s" % (len(ref), len(files), args.directory))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
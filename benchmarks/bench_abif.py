@@ -0,0 +1,80 @@
+"""对比内存映射的 ABIF 读取器与 Biopython SeqIO.read 的加载速度和内存占用
+
+用法:
+    python benchmarks/bench_abif.py a.ab1 b.ab1 ... [--repeat 5]
+
+每种读取方式在单独的子进程里运行，这样峰值 RSS 互不干扰。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+READERS = ("abif", "biopython")
+
+
+def peakRSS():
+    """当前进程的峰值常驻内存（MB），不支持的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位是字节，Linux 是 KB
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def runReader(reader, files, repeat):
+    sys.path.insert(0, ROOT)
+    from Analyser import SangerBaseCall
+
+    baseline = peakRSS()
+    timings = []
+    calls = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        calls = [SangerBaseCall(f, reader=reader) for f in files]
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    return {
+        "reader": reader,
+        "files": len(files),
+        "best_s": best,
+        "per_trace_ms": best / len(files) * 1000,
+        "rss_mb": peakRSS(),
+        "rss_delta_mb": None if baseline is None else peakRSS() - baseline,
+        "bases": sum(len(c.sanger_seq) for c in calls),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--reader", choices=READERS, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.reader:
+        print(json.dumps(runReader(args.reader, args.files, args.repeat)))
+        return
+
+    results = []
+    for reader in READERS:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), "--reader", reader,
+                              "--repeat", str(args.repeat)] + args.files,
+                             check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print("%-10s %12s %14s %12s" % ("reader", "ms/trace", "peak RSS (MB)", "speedup"))
+    slowest = max(r["per_trace_ms"] for r in results)
+    for r in results:
+        rss = "n/a" if r["rss_mb"] is None else "%.1f" % r["rss_mb"]
+        print("%-10s %12.3f %14s %11.1fx" % (r["reader"], r["per_trace_ms"], rss, slowest / r["per_trace_ms"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""报告出图时间基准：旧的 pyplot 写法 vs render.FigureRenderer
+
+    python benchmarks/bench_render.py [--reports 20] [--reads 8] [--length 400] [--threads 4] [--large]
+
+每份报告画 generateReport 中的四张图 (C/CG 峰图、CG 热图、定量热图) 并编码成 PNG。
+数据是随机生成的参考序列和测序结果，不需要测序文件。
+--threads 大于 1 时另外用多个线程同时出图，并检查结果与单线程逐字节一致。
+--large 另外测量测序文件数和参考序列长度增大时，两张热图 (大矩阵模式，含分页) 的出图时间。
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+def makeReports(count, reads, length, seed=0):
+    from Analyser import BSReport
+
+    rng = np.random.default_rng(seed)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    reports = []
+    for _ in range(count):
+        ref = bases[rng.integers(0, 4, length)]
+        matrix = np.repeat(ref[None], reads, axis=0)
+        matrix[(matrix == ord("C")) & (rng.random(matrix.shape) < 0.6)] = ord("T")
+        seqs = [read.tobytes().decode("ascii") for read in matrix]
+        reports.append(BSReport([ref.tobytes().decode("ascii")] + seqs, fractions=rng.random((reads, length))))
+    return reports
+
+
+def figures(report):
+    """generateReport 中画的四张图，逐张产出"""
+    names = ["s%d" % i for i in range(len(report.seqs))]
+    C_peak, _ = report.getmC()
+    CG_peak, _ = report.getmCG()
+    yield lambda: report.plotPeakMap(C_peak, "Methalation state of C")
+    yield lambda: report.plotPeakMap(CG_peak, "Methalation state of CG")
+    yield lambda: report.plotHeatMap(CG_peak, title="Methalation status", rows=names)
+    yield lambda: report.plotQuantHeatMap(CG_peak, title="C/(C+T)", rows=names)
+
+
+def pyplotFigures(report):
+    """旧版 BSReport 的画法：每张图都经过 pyplot 新建，并修改全局 rcParams"""
+    from matplotlib import pyplot as plt
+
+    names = ["s%d" % i for i in range(len(report.seqs))]
+    C_peak, _ = report.getmC()
+    CG_peak, _ = report.getmCG()
+
+    def peak(peak_dic, title):
+        def draw():
+            plt.cla()
+            plt.close("all")
+            plt.rcParams['figure.figsize'] = (15, 4)
+            fig, ax = plt.subplots()
+            ax.plot([peak_dic.get(i, 0) for i in range(len(report.ref))], color="b")
+            plt.xlabel("Reference sequence")
+            plt.ylabel('Nums of methylation')
+            plt.title(title)
+            return plt
+        return draw
+
+    def heat(title, quantitative):
+        def draw():
+            plot_loc = sorted(CG_peak)
+            if quantitative:
+                data = np.ma.masked_invalid(report.fractions[:, plot_loc])
+            else:
+                data = np.zeros((len(report.seqs), len(plot_loc) + 1), dtype=np.uint8)
+                data[:, :-1] = report.calls[:, plot_loc]
+            plt.cla()
+            plt.close("all")
+            plt.rcParams['figure.figsize'] = (15, 4)
+            fig, ax = plt.subplots()
+            fig.tight_layout()
+            if quantitative:
+                cmap = plt.get_cmap("binary").copy()
+                cmap.set_bad("#f4cccc")
+                fig.colorbar(ax.imshow(data, cmap=cmap, vmin=0, vmax=1), ax=ax, label="C/(C+T)")
+            else:
+                ax.imshow(data, cmap="binary")
+            ax.set_xticks(np.arange(data.shape[1] + 1) - .5, minor=True)
+            ax.set_yticks(np.arange(data.shape[0] + 1) - .5, minor=True)
+            ax.grid(which="minor", color="gray", linestyle='-', linewidth=2)
+            ax.set_xticks(np.arange(len(plot_loc)), labels=[loc + 1 for loc in plot_loc])
+            ax.set_yticks(np.arange(len(names)), labels=names)
+            plt.xlabel("CG positions")
+            plt.title(title)
+            return plt
+        return draw
+
+    yield peak(C_peak, "Methalation state of C")
+    yield peak(CG_peak, "Methalation state of CG")
+    yield heat("Methalation status", False)
+    yield heat("C/(C+T)", True)
+
+
+LARGE_SIZES = ((40, 400), (200, 2000), (1000, 5000), (3000, 20000))
+
+
+def largeScaling():
+    print("%-8s %8s %8s %6s %10s" % ("reads", "length", "CpGs", "pages", "heatmap s"))
+    for reads, length in LARGE_SIZES:
+        report, = makeReports(1, reads, length)
+        CG_peak, _ = report.getmCG()
+        names = ["s%d" % i for i in range(reads)]
+
+        def draw():
+            pages = 0
+            for quantitative in (False, True):
+                for fig in report.heatMapPages(CG_peak, rows=names, quantitative=quantitative, cluster=True):
+                    fig.savefig(BytesIO(), format="png")
+                    pages += 1
+            return pages
+
+        elapsed, pages = timed(draw)
+        print("%-8d %8d %8d %6d %10.2f" % (reads, length, len(CG_peak), pages, elapsed))
+
+
+def renderAll(reports, draws):
+    """逐份报告出图，返回每份报告的 PNG 列表"""
+    pngs = []
+    for report in reports:
+        images = []
+        for draw in draws(report):
+            buffer = BytesIO()
+            draw().savefig(buffer, format="png")
+            images.append(buffer.getvalue())
+        pngs.append(images)
+    return pngs
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reports", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=8, help="sequencing files per report")
+    parser.add_argument("--length", type=int, default=400, help="reference length")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--large", action="store_true", help="also time large-matrix heatmaps")
+    args = parser.parse_args(argv)
+
+    reports = makeReports(args.reports, args.reads, args.length)
+    # 预热：字体缓存、导入
+    renderAll(reports[:1], figures)
+    renderAll(reports[:1], pyplotFigures)
+
+    legacy, _ = timed(lambda: renderAll(reports, pyplotFigures))
+    serial, expected = timed(lambda: renderAll(reports, figures))
+    print("%-22s %10s" % ("mode", "ms/report"))
+    print("%-22s %10.1f" % ("pyplot (legacy)", legacy / len(reports) * 1000))
+    print("%-22s %10.1f  (%.2fx)" % ("FigureRenderer", serial / len(reports) * 1000, legacy / serial))
+
+    status = 0
+    if args.threads > 1:
+        # 每个线程各自的报告对象和 renderer
+        copies = [makeReports(args.reports, args.reads, args.length) for _ in range(args.threads)]
+        with ThreadPoolExecutor(args.threads) as pool:
+            elapsed, results = timed(lambda: list(pool.map(lambda r: renderAll(r, figures), copies)))
+        same = all(result == expected for result in results)
+        print("%-22s %10.1f  %s" % ("%d threads" % args.threads, elapsed / (len(reports) * args.threads) * 1000,
+                                    "identical output" if same else "OUTPUT DIFFERS"))
+        status = 0 if same else 1
+    if args.large:
+        print()
+        largeScaling()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
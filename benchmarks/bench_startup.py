@@ -0,0 +1,76 @@
+"""启动时间基准：导入各入口模块、创建主窗口各需要多久
+
+    python benchmarks/bench_startup.py [--repeat 5] [--max-ms 1500]
+
+每次测量都在新的子进程里进行。除了计时，还检查启动后 pandas、matplotlib、
+Biopython 等重模块没有被导入，它们一旦回到启动路径上就报错(返回值非零)。
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 启动时不应导入的模块(requests 只在检查更新的后台线程里导入，不算在内)
+HEAVY_MODULES = ("pandas", "matplotlib.pyplot", "Bio.SeqIO", "Bio.pairwise2", "markdown")
+
+# 名称 -> 在子进程里执行的代码
+CASES = {
+    "import Analyser": "import Analyser",
+    "import cli": "import cli",
+    "main window": (
+        "import os, importlib.util\n"
+        "os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')\n"
+        "from PyQt5.QtWidgets import QApplication\n"
+        "app = QApplication([])\n"
+        "spec = importlib.util.spec_from_file_location('bs_analyser', 'BS-Analyser.py')\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "spec.loader.exec_module(module)\n"
+        "win = module.MyMainWin()\n"
+        "win.show()\n"
+        "app.processEvents()\n"
+    ),
+}
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec(compile(%r, "<startup>", "exec"))
+elapsed = time.perf_counter() - start
+print(json.dumps({"ms": elapsed * 1000, "heavy": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def measure(code):
+    out = subprocess.run([sys.executable, "-c", _PROBE % (code, HEAVY_MODULES)], cwd=ROOT,
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        return None
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if any case is slower than this")
+    args = parser.parse_args(argv)
+
+    failed = False
+    print("%-16s %10s  %s" % ("case", "best ms", "heavy modules loaded"))
+    for name, code in CASES.items():
+        runs = [measure(code) for _ in range(args.repeat)]
+        if None in runs:
+            print("%-16s %10s  (skipped, could not run here)" % (name, "-"))
+            continue
+        best = min(r["ms"] for r in runs)
+        heavy = runs[0]["heavy"]
+        slow = args.max_ms is not None and best > args.max_ms
+        failed = failed or slow or bool(heavy)
+        print("%-16s %10.1f  %s%s" % (name, best, ", ".join(heavy) or "-", "  TOO SLOW" if slow else ""))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
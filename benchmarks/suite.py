@@ -0,0 +1,200 @@
+"""基准测试套件：用 abifgen 生成的模拟测序文件测量各环节的耗时，并与保存的基准比较
+
+    python benchmarks/suite.py [--quick] [--filter align] [--save-baseline] [--compare] [--threshold 1.3]
+
+测试项 (名字/规模)：
+- parse/abif, parse/biopython   解析一个测序文件 (SangerBaseCall)
+- align/<参考序列长度>           比对一个测序文件 (默认比对后端，不含解析)
+- call/<测序文件数>              BSReport 的甲基化判断 (位点掩码、C/CG 判断矩阵)，10 到 10000 条
+- render/<测序文件数>            generateReport 中的四张图，编码为 PNG
+- report/<测序文件数>            BatchEngine.analyse 端到端：解析、比对、出图、写 csv 数据表和 HTML
+
+每项重复运行，取最短时间。--save-baseline 把结果存到 benchmarks/baselines/<主机名>.json；
+--compare 与该文件比较，比基准慢 threshold 倍以上的项标为 REGRESSION，返回值非零；
+还没有基准时 (如刚检出的仓库) 把这次的结果存为基准，返回 0。
+基准按机器分开保存，不同机器之间的时间没有可比性。全部离线运行，只写临时目录。
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+BASELINE_DIR = os.path.join(HERE, "baselines")
+DEFAULT_THRESHOLD = 1.3
+
+ALIGN_LENGTHS = (200, 500, 1000)
+CALL_READS = (10, 100, 1000, 10000)
+RENDER_READS = (8, 200)
+REPORT_READS = (8,)
+QUICK = {"align": (200, 500), "call": (10, 1000), "render": (8,), "report": (4,)}
+
+
+def timed(fn, repeat):
+    """fn 运行 repeat 次的最短时间 (秒)"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def syntheticReport(reads, length, seed=0):
+    """不经过测序文件，直接生成参考序列和亚硫酸氢盐转换后的测序结果"""
+    from abifgen import bisulfiteRead, randomReference
+    from Analyser import BSReport
+
+    rng = np.random.default_rng(seed)
+    ref = randomReference(length, rng)
+    seqs = []
+    fractions = np.empty((reads, length))
+    for i in range(reads):
+        seq, fraction = bisulfiteRead(ref, rng, flank=0)
+        seqs.append(seq)
+        fractions[i] = np.where(np.frombuffer(ref.encode("ascii"), dtype=np.uint8) == ord("C"), fraction, np.nan)
+    return ref, seqs, fractions, BSReport
+
+
+def cases(workdir, sizes):
+    """逐个产出 (名字, 计时的函数)，准备工作 (生成文件等) 在产出之前完成，不计入时间"""
+    from abifgen import makeDataset
+
+    ref, files = makeDataset(os.path.join(workdir, "parse"), reads=1, length=400)
+    for reader in ("abif", "biopython"):
+        def parse(reader=reader):
+            from Analyser import SangerBaseCall
+
+            SangerBaseCall(files[0], reader=reader)
+        yield "parse/" + reader, parse
+
+    for length in sizes["align"]:
+        ref, files = makeDataset(os.path.join(workdir, "align%d" % length), reads=1, length=length, seed=length)
+        from Analyser import SangerBaseCall
+
+        trace = SangerBaseCall(files[0])
+        yield "align/%d" % length, lambda trace=trace, ref=ref: trace.align(ref)
+
+    for reads in sizes["call"]:
+        ref, seqs, fractions, BSReport = syntheticReport(reads, 400, seed=reads)
+
+        def call(ref=ref, seqs=seqs, fractions=fractions, BSReport=BSReport):
+            report = BSReport([ref] + seqs, fractions=fractions)
+            report.getmC()
+            report.getmCG()
+        yield "call/%d" % reads, call
+
+    for reads in sizes["render"]:
+        ref, seqs, fractions, BSReport = syntheticReport(reads, 400, seed=reads)
+        report = BSReport([ref] + seqs, fractions=fractions)
+        names = ["s%d" % i for i in range(reads)]
+
+        def render(report=report, names=names):
+            C_peak, _ = report.getmC()
+            CG_peak, _ = report.getmCG()
+            report.plotPeakMap(C_peak, "Methalation state of C").savefig(os.devnull, format="png")
+            report.plotPeakMap(CG_peak, "Methalation state of CG").savefig(os.devnull, format="png")
+            for quantitative in (False, True):
+                for fig in report.heatMapPages(CG_peak, rows=names, quantitative=quantitative):
+                    fig.savefig(os.devnull, format="png")
+        yield "render/%d" % reads, render
+
+    for reads in sizes["report"]:
+        directory = os.path.join(workdir, "report%d" % reads)
+        ref, files = makeDataset(directory, reads=reads, length=400, seed=reads)
+
+        def report(directory=directory, ref=ref, files=files):
+            from Analyser import AnalysisRow, BatchEngine
+
+            row = AnalysisRow("bench", ref, files, [os.path.basename(f).split("_")[0] for f in files], [], [])
+            for _ in BatchEngine(workers=1).analyse([row], save_path=directory, sheet_formats=("csv",)):
+                pass
+        yield "report/%d" % reads, report
+
+
+def baselinePath():
+    return os.path.join(BASELINE_DIR, platform.node() + ".json")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and repeats")
+    parser.add_argument("--repeat", type=int, default=None, help="runs per case (default 5, 2 with --quick)")
+    parser.add_argument("--filter", default=None, help="only cases whose name contains this text")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as this machine's baseline")
+    parser.add_argument("--compare", action="store_true", help="compare with this machine's baseline")
+    parser.add_argument("--baseline", default=None, help="baseline file (default: benchmarks/baselines/<host>.json)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="flag cases slower than baseline x threshold")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    sizes = dict(QUICK) if args.quick else {"align": ALIGN_LENGTHS, "call": CALL_READS, "render": RENDER_READS,
+                                            "report": REPORT_READS}
+    repeat = args.repeat or (2 if args.quick else 5)
+    baseline_file = args.baseline or baselinePath()
+    baseline = {}
+    save_baseline = args.save_baseline
+    if args.compare:
+        try:
+            with open(baseline_file, encoding="utf-8") as f:
+                baseline = json.load(f)["results"]
+        except FileNotFoundError:
+            print("no baseline at %s yet, this run will be saved as the baseline" % baseline_file, file=sys.stderr)
+            save_baseline = True
+        except (OSError, ValueError, KeyError):
+            print("unreadable baseline at %s, run with --save-baseline to replace it" % baseline_file,
+                  file=sys.stderr)
+            return 2
+
+    workdir = tempfile.mkdtemp(prefix="bs_bench_")
+    results = {}
+    regressions = []
+    try:
+        print("%-20s %12s %12s %8s" % ("case", "ms", "baseline ms", "ratio"))
+        for name, fn in cases(workdir, sizes):
+            if args.filter and args.filter not in name:
+                continue
+            fn()  # 预热：导入、字体缓存
+            seconds = timed(fn, repeat)
+            results[name] = seconds
+            line = "%-20s %12.2f" % (name, seconds * 1000)
+            if name in baseline:
+                ratio = seconds / baseline[name]
+                line += " %12.2f %7.2fx" % (baseline[name] * 1000, ratio)
+                if ratio > args.threshold:
+                    line += "  REGRESSION"
+                    regressions.append(name)
+            print(line, flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {"host": platform.node(), "python": platform.python_version(), "numpy": np.__version__,
+              "date": time.strftime("%Y-%m-%d %H:%M:%S"), "repeat": repeat, "results": results}
+    if save_baseline:
+        os.makedirs(os.path.dirname(baseline_file) or ".", exist_ok=True)
+        with open(baseline_file, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        print("baseline saved to " + baseline_file)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+    if regressions:
+        print("%d regression(s): %s" % (len(regressions), ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""解析结果和比对结果的磁盘缓存
+
+以文件内容的哈希（加上参考序列哈希和比对参数）作为键，数组存成 .npz，
+index.json 记录每个条目的大小和最近使用时间，超过容量时按 LRU 删除。
+同一时间只应有一个进程写 index.json。进程池的子进程用 max_size=None 打开同一个目录：
+条目文件照常读写 (先写临时文件再改名)，不淘汰、不写 index.json，
+而是用 takeChanges 把索引的变化交给主进程，由主进程 mergeChanges 后统一淘汰和 flush。
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from aligner import AlignmentHit
+
+# 缓存格式变化时加一，旧条目自动失效
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".bs_analyser", "cache")
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+
+def fileDigest(path, chunk_size=1 << 20):
+    """文件内容的 sha1"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def textDigest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        """max_size 为 None 时不淘汰条目 (子进程用，见模块说明)"""
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+        self._index_path = os.path.join(self.path, "index.json")
+        try:
+            with open(self._index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self._dirty = False
+        # 上次 takeChanges 之后读写过的条目
+        self._changed = set()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".npz")
+
+    def _load(self, key):
+        file = self._file(key)
+        # 其它进程在本进程读取索引之后写入的条目也能用
+        if key not in self.index and not os.path.exists(file):
+            self.misses += 1
+            return None
+        try:
+            with np.load(file, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            # 文件被删或损坏，当作未命中
+            if self.index.pop(key, None) is not None:
+                self._dirty = True
+            self.misses += 1
+            return None
+        self.index[key] = {"size": self.index.get(key, {}).get("size") or os.path.getsize(file),
+                           "used": time.time()}
+        self._changed.add(key)
+        self._dirty = True
+        self.hits += 1
+        return arrays
+
+    def _save(self, key, arrays):
+        file = self._file(key)
+        tmp = file + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, file)
+        self.index[key] = {"size": os.path.getsize(file), "used": time.time()}
+        self._changed.add(key)
+        self._dirty = True
+        self._evict()
+
+    def takeChanges(self):
+        """上次调用之后读写过的条目 {键: 索引项}，交给主进程的 mergeChanges"""
+        changes = {key: self.index[key] for key in self._changed if key in self.index}
+        self._changed.clear()
+        return changes
+
+    def mergeChanges(self, changes):
+        """合并子进程的 takeChanges，必要时淘汰"""
+        if not changes:
+            return
+        self.index.update(changes)
+        self._dirty = True
+        self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        total = sum(entry["size"] for entry in self.index.values())
+        if total <= self.max_size:
+            return
+        for key in sorted(self.index, key=lambda k: self.index[k]["used"]):
+            total -= self.index.pop(key)["size"]
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+            if total <= self.max_size:
+                break
+
+    @staticmethod
+    def traceKey(digest):
+        return "trace-" + textDigest(CACHE_VERSION, digest)
+
+    @staticmethod
+    def alignmentKey(digest, target_seq, params):
+        return "align-" + textDigest(CACHE_VERSION, digest, textDigest(target_seq), *params)
+
+    def loadTrace(self, digest):
+        return self._load(self.traceKey(digest))
+
+    def saveTrace(self, digest, arrays):
+        self._save(self.traceKey(digest), arrays)
+
+    def loadAlignment(self, digest, target_seq, params):
+        """返回比对结果 AlignmentHit，未命中返回 None"""
+        arrays = self._load(self.alignmentKey(digest, target_seq, params))
+        if arrays is None:
+            return None
+        return AlignmentHit(*(arrays[field].item() for field in AlignmentHit._fields))
+
+    def saveAlignment(self, digest, target_seq, params, hit):
+        self._save(self.alignmentKey(digest, target_seq, params),
+                   {field: np.array(value) for field, value in zip(AlignmentHit._fields, hit)})
+
+    def flush(self):
+        """把索引写回磁盘"""
+        if not self._dirty:
+            return
+        tmp = self._index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self._index_path)
+        self._dirty = False
+
+    def clear(self):
+        for key in list(self.index):
+            try:
+                os.remove(self._file(key))
+            except OSError:
+                pass
+        self.index = {}
+        self._dirty = True
+        self.flush()
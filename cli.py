@@ -0,0 +1,182 @@
+"""命令行批量分析，不需要 Qt 和显示器
+
+表格格式与界面"导出当前表格"一致(.xlsx 或 .csv)，列为
+Ref Name, Ref Sequence, Sequencing Files, Additional locations, Excluded locations。
+
+    python cli.py table.xlsx -o results/ -j 32 --summary summary.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+# 服务器上没有显示器，matplotlib 只用 Agg 出图
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+from aligner import ALIGNERS, DEFAULT_ALIGNER
+from qc import DEFAULT_MIN_SNR, DEFAULT_TRIM_CUTOFF
+from sheets import FORMATS, checkFormats
+
+
+def readTable(path):
+    import pandas as pd
+
+    if path.lower().endswith(".csv"):
+        sheet = pd.read_csv(path, dtype=str)
+    else:
+        sheet = pd.read_excel(path, dtype=str)
+    # exportSheet 导出的表格第一列是没有名字的行号
+    return sheet.loc[:, [c for c in sheet.columns if not str(c).startswith("Unnamed")]]
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("table", help="exported analysis table (.xlsx or .csv)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="directory for Reports/ (default: the table's directory)")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="worker processes (default: number of CPUs, 1 = no process pool)")
+    parser.add_argument("--chunksize", type=int, default=4, help="alignments per worker task")
+    parser.add_argument("--aligner", choices=sorted(ALIGNERS), default=DEFAULT_ALIGNER,
+                        help="seeded/bisulfite: k-mer seeds pick the strand and diagonal, then the read is aligned "
+                             "against the reference window it covers (full DP inside the window, so this only "
+                             "helps when the reference is much longer than the reads)")
+    parser.add_argument("--max-mismatch", type=int, default=10,
+                        help="seeded/bisulfite: reference bases added on each side of the window the read covers, "
+                             "and how far apart seed diagonals may be and still vote together (indel slack); "
+                             "this pads the window, it is not a DP band width")
+    parser.add_argument("--min-snr", type=float, default=DEFAULT_MIN_SNR,
+                        help="reject traces with a lower signal-to-noise ratio before alignment (0 = keep all)")
+    parser.add_argument("--max-secondary", type=float, default=None,
+                        help="also reject traces whose median secondary/primary peak ratio is higher")
+    parser.add_argument("--trim-cutoff", type=float, default=DEFAULT_TRIM_CUTOFF,
+                        help="Mott trimming error-rate cutoff on PCON qualities; only the kept window is aligned "
+                             "(0 = align whole reads)")
+    parser.add_argument("--stream", action="store_true",
+                        help="bounded streaming pipeline: memory stays flat for very large batches, "
+                             "but traces shared between rows are aligned again")
+    parser.add_argument("--cluster-rows", action="store_true",
+                        help="order samples by methylation pattern in large (paged) heatmaps")
+    parser.add_argument("--assets", choices=("inline", "png", "svg"), default="inline",
+                        help="embed figures in the HTML (inline) or write them once to Reports/assets/ as png/svg")
+    parser.add_argument("--sheets", default="csv",
+                        help="comma-separated data sheet formats: %s (default: csv; convert to xlsx later with "
+                             "'python sheets.py Reports/Sheets/*.csv')" % ", ".join(FORMATS))
+    parser.add_argument("--sep", default="_", help="sample name is the file name up to this separator")
+    parser.add_argument("--cache-dir", default=None, help="on-disk cache directory (default: ~/.bs_analyser/cache)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the on-disk cache")
+    parser.add_argument("--store", default=None,
+                        help="SQLite result store the per-read site calls are appended to "
+                             "(default: ~/.bs_analyser/results.sqlite; query it with store.py)")
+    parser.add_argument("--no-store", action="store_true", help="do not append results to the store")
+    parser.add_argument("--force", action="store_true",
+                        help="re-analyse every row even if its inputs and options are unchanged since the last run")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete reports and sheets of rows that are no longer in the table")
+    parser.add_argument("--metrics", default=None,
+                        help="append per-file, per-row and per-run timings and counters to this file as JSON lines "
+                             "('-' for stderr)")
+    parser.add_argument("--report-stats", action="store_true",
+                        help="add a table of per-stage timings to the end of each report")
+    parser.add_argument("--profile", default=None, metavar="ROW",
+                        help="only analyse the row with this Ref Name under cProfile, in a single process, "
+                             "and print the slowest functions (add --no-cache to include parsing and alignment)")
+    parser.add_argument("--profile-out", default=None,
+                        help="where to save the cProfile data (default: <output>/profile/<ROW>.prof; the profiled "
+                             "report also goes to <output>/profile/ so incremental outputs are left alone)")
+    parser.add_argument("--summary", default=None, help="write a JSON summary to this file ('-' for stdout)")
+    return parser
+
+
+def main(argv=None):
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    sheet_formats = tuple(dict.fromkeys(fmt.strip().lower() for fmt in args.sheets.split(",") if fmt.strip()))
+    try:
+        checkFormats(sheet_formats)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.perf_counter()
+
+    from Analyser import PROFILE_DIR, BatchEngine, __version__, rowsFromSheet
+    from cache import DEFAULT_CACHE_DIR, AnalysisCache
+    from instrument import MetricsLog
+    from manifest import RowManifest
+    from store import DEFAULT_STORE, ResultStore
+
+    save_path = args.output or os.path.dirname(os.path.abspath(args.table))
+    os.makedirs(save_path, exist_ok=True)
+
+    rows = rowsFromSheet(readTable(args.table), sep=args.sep)
+    if args.profile is not None and args.profile not in [row.name for _, row in rows]:
+        parser.error("no row named %r in %s" % (args.profile, args.table))
+    cache = None if args.no_cache else AnalysisCache(args.cache_dir or DEFAULT_CACHE_DIR)
+    manifest = RowManifest(save_path, __version__, force=args.force)
+    store = None if args.no_store or args.profile else ResultStore(args.store or DEFAULT_STORE)
+    metrics = MetricsLog(args.metrics) if args.metrics else None
+    engine = BatchEngine(workers=args.workers, chunksize=args.chunksize, aligner=args.aligner, cache=cache,
+                         max_mismatch=args.max_mismatch,
+                         min_snr=args.min_snr or None, max_secondary=args.max_secondary,
+                         trim_cutoff=args.trim_cutoff or None, store=store,
+                         streaming=args.stream, metrics=metrics, report_stats=args.report_stats)
+    report_options = {"cluster_rows": args.cluster_rows, "assets": args.assets, "sheet_formats": sheet_formats}
+
+    if args.profile is not None:
+        row = next(row for _, row in rows if row.name == args.profile)
+        output = args.profile_out or os.path.join(save_path, PROFILE_DIR, row.name + ".prof")
+        try:
+            stats = engine.profile(row, save_path=save_path, output=output, **report_options)
+        finally:
+            if cache is not None:
+                cache.flush()
+            if metrics is not None:
+                metrics.close()
+        stats.stream = sys.stderr
+        stats.sort_stats("cumulative").print_stats(25)
+        print("profile saved to %s; %s" % (output, engine.statsText()), file=sys.stderr)
+        return 0
+
+    summary = {"table": os.path.abspath(args.table), "output": os.path.abspath(save_path),
+               "workers": engine.workers, "aligner": args.aligner, "rows": []}
+    status = 0
+    try:
+        for index, report_path in engine.analyse([row for _, row in rows], save_path=save_path,
+                                                   run_label=os.path.abspath(args.table), manifest=manifest,
+                                                   **report_options):
+            table_row, row = rows[index]
+            summary["rows"].append({"row": table_row, "name": row.name, "files": len(row.sanger_files),
+                                    "report": os.path.abspath(report_path)})
+            print("[%d/%d] %s -> %s" % (index + 1, len(rows), row.name, report_path), file=sys.stderr)
+        if args.prune:
+            manifest.prune([row.name for _, row in rows])
+    except Exception as e:
+        print("error: %s" % e, file=sys.stderr)
+        summary["error"] = str(e)
+        status = 1
+    finally:
+        if cache is not None:
+            cache.flush()
+        if store is not None:
+            store.close()
+        if metrics is not None:
+            metrics.close()
+
+    print(engine.statsText(), file=sys.stderr)
+    summary["stats"] = engine.stats
+    summary["instrumentation"] = engine.runStats()
+    summary["pruned_files"] = manifest.removed
+    if store is not None:
+        summary["store"] = {"path": os.path.abspath(store.path), "calls": store.inserted}
+    summary["elapsed_s"] = round(time.perf_counter() - start, 3)
+    if args.summary == "-":
+        json.dump(summary, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    elif args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
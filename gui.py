@@ -148,6 +148,9 @@ class Ui_MainWindow(object):
         self.lineEdit_path = QtWidgets.QLineEdit(self.groupBox_6)
         self.lineEdit_path.setObjectName("lineEdit_path")
         self.verticalLayout_3.addWidget(self.lineEdit_path)
+        self.checkBox_excel_sheets = QtWidgets.QCheckBox(self.groupBox_6)
+        self.checkBox_excel_sheets.setObjectName("checkBox_excel_sheets")
+        self.verticalLayout_3.addWidget(self.checkBox_excel_sheets)
         self.pushButton_start = QtWidgets.QPushButton(self.groupBox_6)
         self.pushButton_start.setObjectName("pushButton_start")
         self.verticalLayout_3.addWidget(self.pushButton_start)
@@ -219,6 +222,7 @@ class Ui_MainWindow(object):
         self.groupBox_4.setTitle(_translate("MainWindow", "分隔符"))
         self.lineEdit_sep.setText(_translate("MainWindow", "_"))
         self.groupBox_6.setTitle(_translate("MainWindow", "存储目录"))
+        self.checkBox_excel_sheets.setText(_translate("MainWindow", "同时导出 Excel 数据表 (较慢)"))
         self.pushButton_start.setText(_translate("MainWindow", "设置存储路径并开始分析"))
         self.pushButton_open_folder.setText(_translate("MainWindow", "打开存储目录"))
         self.label_lyric.setText(_translate("MainWindow", "BS-seq Analyzer\n"
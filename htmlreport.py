@@ -0,0 +1,92 @@
+"""流式写出 HTML 报告
+
+报告按段落顺序直接写进文件：文字段落各自转换 Markdown，图片在画好后立即写出，
+不再把整份报告拼成一个字符串再做 Markdown 转换。
+
+图片有两种存放方式：
+- 内嵌 (assets_dir 为 None)：base64 写在 HTML 里，报告是单个文件
+- 外部文件：按内容的 sha1 命名存到 assets_dir，内容相同的图只写一次，多份报告共用
+"""
+import base64
+import hashlib
+import os
+from io import BytesIO
+
+HEADER = """<meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>\n\n"""
+MIME_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+# SVG 里的元素 id 默认用随机数生成，固定下来才能让相同的图得到相同的内容
+SVG_HASHSALT = "bs-analyser"
+
+
+def figureBytes(fig, image_format="png"):
+    """把 Figure (或任何有 savefig 的对象) 保存为 png/svg 字节串，相同的图得到相同的结果"""
+    buffer = BytesIO()
+    if image_format == "svg":
+        from matplotlib import rc_context
+
+        with rc_context({"svg.hashsalt": SVG_HASHSALT}):
+            fig.savefig(buffer, format="svg", metadata={"Date": None})
+    else:
+        fig.savefig(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class ReportWriter:
+    def __init__(self, path, assets_dir=None, image_format="png"):
+        """path 为 HTML 文件；assets_dir 不为 None 时图片存为该目录下的文件，HTML 里用相对路径引用"""
+        if image_format not in MIME_TYPES:
+            raise ValueError("Unknown image format: " + str(image_format))
+        self.path = path
+        self.assets_dir = assets_dir
+        self.image_format = image_format
+        # 新写出和已存在而复用的图片数
+        self.written = 0
+        self.reused = 0
+        # 报告引用的图片文件 (外部文件时)
+        self.files = []
+        if assets_dir is not None:
+            os.makedirs(assets_dir, exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write(HEADER)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def markdown(self, text):
+        """写一段 Markdown 文字"""
+        import markdown
+
+        if text.strip():
+            self._file.write(markdown.markdown(text, extensions=["tables"]) + "\n")
+
+    def html(self, text):
+        self._file.write(text)
+
+    def rule(self):
+        self._file.write("<hr />\n")
+
+    def image(self, fig, alt=""):
+        """写一张图，fig 需要在调用时就画好 (FigureRenderer 的 Figure 会被下一张图复用)"""
+        data = figureBytes(fig, self.image_format)
+        if self.assets_dir is None:
+            src = "data:%s;base64,%s" % (MIME_TYPES[self.image_format], base64.b64encode(data).decode("ascii"))
+        else:
+            name = hashlib.sha1(data).hexdigest() + "." + self.image_format
+            file = os.path.join(self.assets_dir, name)
+            if os.path.exists(file):
+                self.reused += 1
+            else:
+                tmp = file + ".tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, file)
+                self.written += 1
+            self.files.append(file)
+            src = os.path.relpath(file, os.path.dirname(os.path.abspath(self.path))).replace(os.sep, "/")
+        self._file.write('<p><img alt="%s" src="%s" /></p>\n' % (alt, src))
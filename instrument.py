@@ -0,0 +1,131 @@
+"""运行时的计时和计数
+
+各环节 (解析、质控、比对、峰高比例、甲基化判断、出图、数据表……) 用 stage() 包起来，
+累计调用次数、墙钟时间和 CPU 时间；count() 记录计数。记录器每个进程一个 (recorder())，
+进程池的子进程把本组任务的增量 (since) 随结果一起返回，由主进程 merge。
+
+MetricsLog 把事件按 JSON lines 写出，每行一个 {"event": ..., "time": ..., ...}。
+"""
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 环节名 -> [次数, 墙钟秒数, CPU 秒数]
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """计时一个环节。CPU 时间为整个进程的，有其它线程同时工作时会偏大"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self._lock:
+                entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += wall
+                entry[2] += cpu
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self._lock:
+            return {"stages": {name: list(entry) for name, entry in self.stages.items()},
+                    "counters": dict(self.counters)}
+
+    def since(self, snapshot):
+        """从 snapshot 到现在的增量，格式同 snapshot，没有变化的项不列出"""
+        now = self.snapshot()
+        stages = {}
+        for name, entry in now["stages"].items():
+            old = snapshot["stages"].get(name, [0, 0.0, 0.0])
+            if entry[0] != old[0]:
+                stages[name] = [entry[0] - old[0], entry[1] - old[1], entry[2] - old[2]]
+        counters = {name: value - snapshot["counters"].get(name, 0) for name, value in now["counters"].items()
+                    if value != snapshot["counters"].get(name, 0)}
+        return {"stages": stages, "counters": counters}
+
+    def merge(self, delta):
+        """加上其它进程的增量"""
+        with self._lock:
+            for name, (calls, wall, cpu) in delta["stages"].items():
+                entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += wall
+                entry[2] += cpu
+            for name, value in delta["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+
+_recorder = Recorder()
+
+
+def recorder():
+    """当前进程的 Recorder"""
+    return _recorder
+
+
+def stage(name):
+    return _recorder.stage(name)
+
+
+def count(name, n=1):
+    _recorder.count(name, n)
+
+
+def peakMemory():
+    """{"self": 本进程峰值常驻内存 MB, "children": 已结束子进程中最大的峰值 MB}，不支持的平台为 None"""
+    try:
+        import resource
+    except ImportError:
+        return {"self": None, "children": None}
+    # macOS 单位是字节，Linux 是 KB
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def formatStages(delta, top=4):
+    """耗时最多的几个环节，如 "align 1.20s, render 0.52s"，用于状态栏"""
+    stages = sorted(delta["stages"].items(), key=lambda item: -item[1][1])[:top]
+    return ", ".join("%s %.2fs" % (name, entry[1]) for name, entry in stages)
+
+
+def stageTable(delta):
+    """各环节耗时的 Markdown 表格"""
+    lines = ["| Stage | Calls | Wall (s) | CPU (s) |", "| --- | --- | --- | --- |"]
+    for name, (calls, wall, cpu) in sorted(delta["stages"].items(), key=lambda item: -item[1][1]):
+        lines.append("| %s | %d | %.3f | %.3f |" % (name, calls, wall, cpu))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsLog:
+    def __init__(self, path):
+        """path 为 "-" 时写到标准错误"""
+        self._file = sys.stderr if path == "-" else open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, event, **fields):
+        line = json.dumps(dict({"event": event, "time": round(time.time(), 3)}, **fields), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._file is not sys.stderr:
+            self._file.close()
@@ -0,0 +1,128 @@
+"""界面上显示的诗词
+
+后台线程预取一批诗词放在内存里，同时写到磁盘(带过期时间)，界面取诗词时从不联网等待。
+设置环境变量 BS_ANALYSER_OFFLINE=1 (或调用 setOffline(True)) 后完全不联网。
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+LYRIC_URL = 'https://v1.jinrishici.com/all'
+DEFAULT_LYRIC = "BS-Seq Analyser" + "\n\t\t\t" + "——Written by M.Q. at ShanghaiTech University"
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".bs_analyser", "lyrics.json")
+
+
+def offlineMode():
+    return os.environ.get("BS_ANALYSER_OFFLINE", "").lower() in ("1", "true", "yes", "on")
+
+
+def formatLyric(lyric):
+    content = lyric['content']
+    origin = lyric.get('origin') or "Unknown"
+    author = lyric.get('author') or "Unknown"
+    return content + "\n\t\t\t" + "——《" + origin + "》\t" + author
+
+
+class LyricFetcher:
+    def __init__(self, pool_size=10, ttl=24 * 3600, cache_file=DEFAULT_CACHE_FILE, offline=None, timeout=2):
+        self.pool_size = pool_size
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.offline = offlineMode() if offline is None else offline
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._thread = None
+        # [诗词, 获取时间]
+        self._pool = deque(self._load())
+
+    def _load(self):
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return []
+        now = time.time()
+        return [entry for entry in entries if now - entry[1] < self.ttl]
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with self._lock:
+                entries = list(self._pool)
+            tmp = self.cache_file + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp, self.cache_file)
+        except OSError:
+            pass
+
+    def setOffline(self, offline):
+        self.offline = offline
+
+    def get(self):
+        """立即返回一条诗词，池子不满时在后台补充"""
+        now = time.time()
+        with self._lock:
+            while self._pool and now - self._pool[0][1] >= self.ttl:
+                self._pool.popleft()
+            entry = None
+            if self._pool:
+                # 轮换着显示
+                entry = self._pool.popleft()
+                self._pool.append(entry)
+            short = len(self._pool) < self.pool_size
+        if short:
+            self.prefetch()
+        return entry[0] if entry else DEFAULT_LYRIC
+
+    def prefetch(self):
+        if self.offline or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            import requests
+        except ImportError:
+            return
+        fetched = False
+        while not self.offline:
+            with self._lock:
+                if len(self._pool) >= self.pool_size:
+                    break
+            try:
+                text = formatLyric(requests.get(LYRIC_URL, timeout=self.timeout).json())
+            except Exception:
+                # 没有网络就等下次再试
+                break
+            with self._lock:
+                self._pool.append([text, time.time()])
+            fetched = True
+        if fetched:
+            self._save()
+
+
+_fetcher = None
+
+
+def defaultFetcher():
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = LyricFetcher()
+    return _fetcher
+
+
+def getLyric():
+    """从默认的诗词来源取一条，第一次调用时开始预取"""
+    return defaultFetcher().get()
+
+
+def prefetch():
+    defaultFetcher().prefetch()
+
+
+def setOffline(offline):
+    defaultFetcher().setOffline(offline)
@@ -0,0 +1,159 @@
+"""增量分析：记录每行输入和输出的清单
+
+清单存在输出目录下的 .bs_manifest/ (与 Reports/ 并列)：manifest.json 记录每行 (按报告名) 的
+- analysis: 参考序列、测序文件内容、样品名、比对和质控参数、程序版本的哈希
+- render: add_locs/exc_locs 和报告选项 (cluster_rows、assets、sheet_formats) 的哈希
+- outputs: 该行写出的文件 (报告、数据表、图片)，相对输出目录
+以及每行比对后的结果 (rows/ 下的 .npz 和清单中的质控记录)。
+
+再次分析时 (RowManifest.plan)：
+- 两个哈希都没变、输出文件都在：跳过
+- 只有 render 变了：用保存的比对结果重新出报告，不再解析和比对
+- 其它情况：重新分析
+重新出报告后不再属于该行的旧输出会被删除 (其它行还在用的图片保留)；
+prune 删除表格中已经没有的行的输出。
+"""
+import json
+import os
+
+import numpy as np
+
+from cache import fileDigest, textDigest
+from qc import TraceQC
+
+MANIFEST_DIR = ".bs_manifest"
+# 清单格式变化时加一，旧清单作废
+MANIFEST_VERSION = 1
+
+SKIP, RENDER, ANALYSE = "skip", "render", "analyse"
+
+
+class RowManifest:
+    def __init__(self, save_path, version, force=False):
+        """save_path 为 Reports/ 所在的目录，version 为程序版本，版本不同时所有行都重新分析。
+        force 为 True 时不使用旧记录 (全部重新分析)，但仍然记录新的结果"""
+        self.save_path = save_path
+        self.version = version
+        self.force = force
+        self.path = os.path.join(save_path, MANIFEST_DIR)
+        os.makedirs(os.path.join(self.path, "rows"), exist_ok=True)
+        self._file = os.path.join(self.path, "manifest.json")
+        try:
+            with open(self._file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("format") != MANIFEST_VERSION:
+            data = {}
+        self.rows = data.get("rows", {})
+        # {测序文件路径: [大小, 修改时间, sha1]}，文件没变时不用重新计算哈希
+        self.files = data.get("files", {})
+        self.removed = 0
+
+    def save(self):
+        tmp = self._file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": MANIFEST_VERSION, "rows": self.rows, "files": self.files}, f)
+        os.replace(tmp, self._file)
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = fileDigest(path)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def analysisKey(self, row, params):
+        """params 为影响比对和质控结果的参数 (BatchEngine.params)"""
+        return textDigest(self.version, row.ref_sequence.upper(), *params,
+                          *(self._digest(f) for f in row.sanger_files), *row.sanger_names)
+
+    def renderKey(self, row, options):
+        return textDigest(self.version, row.add_locs, row.exc_locs, sorted(options.items()))
+
+    def _state(self, row):
+        return os.path.join(self.path, "rows", textDigest(row.name) + ".npz")
+
+    def plan(self, row, params, options):
+        """该行要做的事：SKIP、RENDER 或 ANALYSE"""
+        if self.force:
+            return ANALYSE
+        entry = self.rows.get(row.name)
+        try:
+            analysis = self.analysisKey(row, params)
+        except OSError:
+            # 测序文件不存在，交给分析时报错
+            return ANALYSE
+        if entry is None or entry["analysis"] != analysis or not os.path.exists(self._state(row)):
+            return ANALYSE
+        outputs_exist = all(os.path.exists(os.path.join(self.save_path, f)) for f in entry["outputs"])
+        if entry["render"] != self.renderKey(row, options) or not outputs_exist:
+            return RENDER
+        return SKIP
+
+    def reportPath(self, row):
+        return os.path.join(self.save_path, self.rows[row.name]["report"])
+
+    def load(self, row):
+        """保存的比对结果：(质控后的 AnalysisRow, sub_result, fractions, qc)，与 BatchEngine.run 的产出一致"""
+        entry = self.rows[row.name]
+        with np.load(self._state(row), allow_pickle=False) as data:
+            sub_result = data["sub_result"].tolist()
+            fractions = data["fractions"] if "fractions" in data.files else None
+        kept = row._replace(sanger_files=entry["kept"][0], sanger_names=entry["kept"][1])
+        qc = [(name, sanger_file, TraceQC(*trace_qc), reasons)
+              for name, sanger_file, trace_qc, reasons in entry["qc"]]
+        return kept, sub_result, fractions, qc
+
+    def record(self, row, params, options, kept, sub_result, fractions, qc, report_path, outputs):
+        """记录一行的结果和输出文件，并删除该行不再使用的旧输出"""
+        arrays = {"sub_result": np.array(sub_result, dtype=str)}
+        if fractions is not None:
+            arrays["fractions"] = np.asarray(fractions)
+        state = self._state(row)
+        np.savez(state + ".tmp.npz", **arrays)
+        os.replace(state + ".tmp.npz", state)
+
+        old = self.rows.get(row.name)
+        self.rows[row.name] = {
+            "analysis": self.analysisKey(row, params),
+            "render": self.renderKey(row, options),
+            "report": self._relative(report_path),
+            "outputs": sorted({self._relative(f) for f in outputs}),
+            "kept": [list(kept.sanger_files), list(kept.sanger_names)],
+            "qc": [(name, sanger_file, list(trace_qc), reasons) for name, sanger_file, trace_qc, reasons in qc],
+        }
+        if old is not None:
+            self._removeOutputs(set(old["outputs"]) - set(self.rows[row.name]["outputs"]))
+        self.save()
+
+    def prune(self, names):
+        """删除不在 names 中的行的输出和记录，返回删除的行数"""
+        stale = [name for name in self.rows if name not in set(names)]
+        for name in stale:
+            entry = self.rows.pop(name)
+            self._removeOutputs(entry["outputs"])
+            try:
+                os.remove(os.path.join(self.path, "rows", textDigest(name) + ".npz"))
+            except OSError:
+                pass
+        if stale:
+            self.save()
+        return len(stale)
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.save_path).replace(os.sep, "/")
+
+    def _removeOutputs(self, outputs):
+        # 图片按内容命名，可能被其它行的报告引用
+        in_use = {f for entry in self.rows.values() for f in entry["outputs"]}
+        for output in outputs:
+            if output in in_use:
+                continue
+            try:
+                os.remove(os.path.join(self.save_path, output))
+                self.removed += 1
+            except OSError:
+                pass
@@ -0,0 +1,266 @@
+"""流式分析流水线：测序文件来源 -> 解析 -> 比对 -> 甲基化判断 -> 按行汇总 -> 报告
+
+每一步都是生成器函数，接收上一步的迭代器、逐条产出结果，可以替换成自己的来源或输出，也可以插入别的步骤：
+
+    calls = callStage(alignStage(parseStage(traceSource(rows))))
+    for index, report_path in reportSink(rowResults(calls, rows=rows), save_path):
+        ...
+
+buffered() 把一段流水线放到后台线程，与后面的步骤之间是有界队列，前面最多领先 maxsize 条；
+parallelStage() 在进程池里完成解析、比对和判断，同时在途的任务数有上限。
+每条测序结果在判断之后就只剩比对到参考序列上的碱基和峰高比例，解析结果 (SangerBaseCall) 随即释放，
+因此内存只与队列长度和单行的测序文件数有关，不随批量大小增长。
+
+与 BatchEngine.run 的默认方式不同，这里不在整个批次内复用解析、比对结果 (复用需要把它们都留在内存里)，
+需要复用时在单进程方式中传入 AnalysisCache。
+"""
+import os
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from Analyser import BSReport, SangerBaseCall
+from aligner import DEFAULT_ALIGNER, getAligner
+from instrument import recorder, stage
+from qc import DEFAULT_MIN_SNR, DEFAULT_TRIM_CUTOFF
+
+# 队列长度和每个进程在途的任务组数
+DEFAULT_QUEUE_SIZE = 8
+PENDING_PER_WORKER = 2
+
+# row_index 为行序号，row 为 AnalysisRow
+TraceTask = namedtuple("TraceTask", "row_index row sanger_file sanger_name")
+# 一条测序结果的判断：aligned_read 为按参考序列坐标排好的碱基 (见 AlignmentHit.alignedRead)，
+# fraction 为 C/(C+T) 峰高比例；质控不合格时 reasons 不为空，aligned_read 和 fraction 为 None；
+# cached 为 True 表示比对结果是从磁盘缓存读出的
+ReadCall = namedtuple("ReadCall", "task aligned_read fraction qc reasons cached", defaults=(False,))
+# 与 BatchEngine.run 的产出一致
+RowResult = namedtuple("RowResult", "index row sub_result fractions qc")
+
+
+def traceSource(rows):
+    """rows 为 AnalysisRow 的可迭代对象 (可以是生成器)，逐个产出 TraceTask"""
+    for index, row in enumerate(rows):
+        for sanger_file, sanger_name in zip(row.sanger_files, row.sanger_names):
+            yield TraceTask(index, row, sanger_file, sanger_name)
+
+
+def parseStage(tasks, reader="abif", cache=None, aligner=DEFAULT_ALIGNER, trim_cutoff=DEFAULT_TRIM_CUTOFF):
+    """产出 (TraceTask, SangerBaseCall)"""
+    aligner = getAligner(aligner)
+    for task in tasks:
+        yield task, SangerBaseCall(task.sanger_file.strip(), reader=reader, cache=cache, aligner=aligner,
+                                   trim_cutoff=trim_cutoff)
+
+
+def alignStage(items, max_mismatch=10, min_snr=DEFAULT_MIN_SNR, max_secondary=None):
+    """产出 (TraceTask, SangerBaseCall, AlignmentHit, 不合格原因)，质控不合格的不比对，AlignmentHit 为 None"""
+    for task, trace in items:
+        reasons = trace.qc.failures(min_snr, max_secondary)
+        hit = None if reasons else trace.align(task.row.ref_sequence, max_mismatch)
+        yield task, trace, hit, reasons
+
+
+def callStage(items, quantitative=True):
+    """产出 ReadCall，之后不再引用 SangerBaseCall"""
+    for task, trace, hit, reasons in items:
+        if reasons:
+            yield ReadCall(task, None, None, trace.qc, reasons)
+            continue
+        ref_sequence = task.row.ref_sequence
+        fraction = trace.methylationFractions(ref_sequence, hit) if quantitative else None
+        yield ReadCall(task, hit.alignedRead(len(ref_sequence)), fraction, trace.qc, reasons, trace.alignment_cached)
+
+
+def _callChunk(jobs, options):
+    """子进程中完成一组 (测序文件, 参考序列) 的解析、比对和判断，返回 (ReadCall 列表 (task 为 None), 计时增量)"""
+    before = recorder().snapshot()
+    tasks = [TraceTask(None, _JobRow(ref_sequence), sanger_file, None) for sanger_file, ref_sequence in jobs]
+    stages = callStage(alignStage(parseStage(tasks, options["reader"], None, options["aligner"],
+                                             options["trim_cutoff"]),
+                                  options["max_mismatch"], options["min_snr"], options["max_secondary"]),
+                       options["quantitative"])
+    calls = [call._replace(task=None) for call in stages]
+    return calls, recorder().since(before)
+
+
+# 子进程中只需要参考序列
+_JobRow = namedtuple("_JobRow", "ref_sequence")
+
+
+def parallelStage(tasks, workers=None, chunksize=4, max_pending=None, reader="abif", aligner=DEFAULT_ALIGNER,
+                  trim_cutoff=DEFAULT_TRIM_CUTOFF, max_mismatch=10, quantitative=True, min_snr=DEFAULT_MIN_SNR,
+                  max_secondary=None):
+    """在进程池中完成 parseStage、alignStage、callStage，按输入顺序产出 ReadCall。
+    每 chunksize 个测序文件为一组提交，同时在途的组数不超过 max_pending (默认每个进程 PENDING_PER_WORKER 组)"""
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    max_pending = max_pending or workers * PENDING_PER_WORKER
+    options = {"reader": reader, "aligner": getAligner(aligner), "trim_cutoff": trim_cutoff,
+               "max_mismatch": max_mismatch, "quantitative": quantitative, "min_snr": min_snr,
+               "max_secondary": max_secondary}
+    pool = ProcessPoolExecutor(workers)
+    pending = deque()
+    tasks = iter(tasks)
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                chunk = [task for _, task in zip(range(chunksize), tasks)]
+                if not chunk:
+                    exhausted = True
+                    break
+                jobs = [(task.sanger_file, task.row.ref_sequence) for task in chunk]
+                pending.append((chunk, pool.submit(_callChunk, jobs, options)))
+            if not pending:
+                return
+            chunk, future = pending.popleft()
+            with stage("wait"):
+                calls, delta = future.result()
+            recorder().merge(delta)
+            for task, call in zip(chunk, calls):
+                yield call._replace(task=task)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def rowResults(calls, quantitative=True, rows=None):
+    """把按顺序到达的 ReadCall 按行汇总，一行的测序文件都到齐就产出该行的 RowResult。
+    质控剔除的测序文件不在 row、sub_result 和 fractions 中，qc 为该行全部测序文件的
+    [(样品名, 测序文件, TraceQC, 不合格原因)]。quantitative 与 callStage 的一致。
+    traceSource 不为没有测序文件的行产出任务，rows 为传给 traceSource 的全部行 (列表) 时，
+    这些行也按顺序产出 (sub_result 只有参考序列，与 BatchEngine.run 一致)，
+    并检查行序号，结果对不上行时报错而不是错位。
+    calls 提前结束 (取消) 时，还没到齐的行不产出"""
+    row_calls = []
+    next_index = 0
+
+    def finish():
+        task = row_calls[0].task
+        row, ref_sequence = task.row, task.row.ref_sequence
+        kept = [call for call in row_calls if not call.reasons]
+        fractions = None
+        if quantitative:
+            fractions = np.array([call.fraction for call in kept]).reshape(len(kept), len(ref_sequence))
+        if len(kept) < len(row_calls):
+            row = row._replace(sanger_files=[call.task.sanger_file for call in kept],
+                               sanger_names=[call.task.sanger_name for call in kept])
+        qc = [(call.task.sanger_name, call.task.sanger_file, call.qc, call.reasons) for call in row_calls]
+        return RowResult(task.row_index, row, [ref_sequence] + [call.aligned_read for call in kept], fractions, qc)
+
+    def emptyRows(until):
+        # next_index 到 until 之间的行都应该没有测序文件
+        nonlocal next_index
+        while next_index < until:
+            row = rows[next_index]
+            if row.sanger_files:
+                raise RuntimeError("no trace results for row %d (%s)" % (next_index, row.name))
+            fractions = np.empty((0, len(row.ref_sequence))) if quantitative else None
+            yield RowResult(next_index, row, [row.ref_sequence], fractions, [])
+            next_index += 1
+
+    for call in calls:
+        index = call.task.row_index
+        if row_calls and index != row_calls[0].task.row_index:
+            raise RuntimeError("row %d (%s) is missing trace results" % (row_calls[0].task.row_index,
+                                                                        row_calls[0].task.row.name))
+        if not row_calls and rows is not None:
+            yield from emptyRows(index)
+        row_calls.append(call)
+        if len(row_calls) == len(call.task.row.sanger_files):
+            yield finish()
+            row_calls = []
+            next_index = index + 1
+    # 后面只剩没有测序文件的行时说明 calls 是完整的，补上这些行
+    if not row_calls and rows is not None and not any(row.sanger_files for row in rows[next_index:]):
+        yield from emptyRows(len(rows))
+
+
+def reportSink(results, save_path="", store=None, run_label=None, **report_options):
+    """为每个 RowResult 生成报告，产出 (行序号, 报告路径)。
+    store 为 store.ResultStore 时同时写入结果库；report_options 传给 BSReport.generateReport"""
+    run = None
+    for index, row, sub_result, fractions, qc in results:
+        report = BSReport(sub_result, fractions=fractions)
+        if store is not None:
+            # 有结果时才建批次
+            if run is None:
+                run = store.beginRun(run_label)
+            store.addReport(run, row, report)
+        yield index, report.generateReport(ref_seq=row.ref_sequence, sanger_names=row.sanger_names,
+                                           add_locs=row.add_locs, exc_locs=row.exc_locs, report_name=row.name,
+                                           save_path=save_path, qc=qc, **report_options)
+
+
+_DONE = object()
+
+
+def buffered(iterable, maxsize=DEFAULT_QUEUE_SIZE):
+    """在后台线程里迭代 iterable，经过长度为 maxsize 的队列逐条产出。
+    iterable 中的异常在取到该位置时重新抛出；提前停止迭代时后台线程也随之停止"""
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # 队列满时定期检查是否已经停止，避免后台线程永远阻塞
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    break
+            else:
+                put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="pipeline-buffer", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def readCalls(rows, workers=None, chunksize=4, reader="abif", aligner=DEFAULT_ALIGNER, cache=None, max_mismatch=10,
+              quantitative=True, min_snr=DEFAULT_MIN_SNR, max_secondary=None, trim_cutoff=DEFAULT_TRIM_CUTOFF,
+              queue_size=DEFAULT_QUEUE_SIZE):
+    """rows 中全部测序文件的 ReadCall，解析和比对在后台进行，最多领先调用方 queue_size 条。
+    参数同 BatchEngine；workers <= 1 时在后台线程里单进程运行 (可以使用 cache)，否则用 parallelStage (不使用 cache)"""
+    tasks = traceSource(rows)
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    if workers <= 1:
+        calls = callStage(alignStage(parseStage(tasks, reader, cache, aligner, trim_cutoff),
+                                     max_mismatch, min_snr, max_secondary), quantitative)
+    else:
+        calls = parallelStage(tasks, workers, chunksize, reader=reader, aligner=aligner, trim_cutoff=trim_cutoff,
+                              max_mismatch=max_mismatch, quantitative=quantitative, min_snr=min_snr,
+                              max_secondary=max_secondary)
+    return buffered(calls, queue_size)
+
+
+def streamAnalysis(rows, quantitative=True, **options):
+    """组合好的流水线：逐行产出 RowResult (包括没有测序文件的行)，options 见 readCalls"""
+    rows = list(rows)
+    return rowResults(readCalls(rows, quantitative=quantitative, **options), quantitative, rows)
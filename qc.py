@@ -0,0 +1,100 @@
+"""测序峰图的噪音和信噪比，用于在比对之前剔除失败的测序；以及按碱基质量值修剪两端
+
+对每个碱基的峰值位置 (PLOC1)：
+- 基线取该位置前后 window 个采样点内各通道信号的最小值，信号减去基线后再比较
+- 某通道的信号：该通道被读成碱基时峰值处的高度
+- 某通道的噪音：其它碱基的峰值处，该通道的高度
+- 次峰比例：峰值处另外三个通道中最高者与主峰的比值 (亚硫酸氢盐测序中 C/T 混合峰是正常的，默认不据此剔除)
+"""
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# DATA9-12 四个信号通道依次对应的碱基
+CHANNELS = "GATC"
+
+DEFAULT_WINDOW = 50
+DEFAULT_MIN_SNR = 3.0
+# Mott 修剪的错误率阈值，与 Biopython 的 abi-trim 相同
+DEFAULT_TRIM_CUTOFF = 0.05
+
+
+class TraceQC(namedtuple("TraceQC", "snr channel_snr noise secondary_ratio n_peaks")):
+    """snr 为各通道信噪比的中位数；channel_snr、noise 为 {碱基: 值}，没有数据的通道为 nan；
+    secondary_ratio 为次峰与主峰比值的中位数；n_peaks 为参与统计的峰数"""
+
+    def failures(self, min_snr=DEFAULT_MIN_SNR, max_secondary=None):
+        """不合格的原因列表，合格时为空。阈值为 None 时不检查该项"""
+        reasons = []
+        if self.n_peaks == 0:
+            reasons.append("no peaks")
+        if min_snr is not None and not self.snr >= min_snr:
+            reasons.append("S/N %.1f < %g" % (self.snr, min_snr))
+        if max_secondary is not None and not self.secondary_ratio <= max_secondary:
+            reasons.append("secondary peaks %.2f > %g" % (self.secondary_ratio, max_secondary))
+        return reasons
+
+
+def noiseProfile(traces, base_locations, base_calls, window=DEFAULT_WINDOW):
+    """traces 为 (4, N) 信号矩阵 (行顺序同 CHANNELS)，base_locations/base_calls 为峰值位置和碱基 (ASCII)。
+    返回 TraceQC"""
+    traces = np.asarray(traces)
+    base_locations = np.asarray(base_locations, dtype=np.int64)
+    base_calls = np.asarray(base_calls, dtype=np.uint8)
+    nan = {base: float("nan") for base in CHANNELS}
+
+    # 只统计落在信号范围内、读成 ACGT 的峰
+    channel = np.full(256, -1, dtype=np.int64)
+    channel[np.frombuffer(CHANNELS.encode("ascii"), dtype=np.uint8)] = np.arange(len(CHANNELS))
+    called = channel[base_calls]
+    keep = (called >= 0) & (base_locations >= 0) & (base_locations < traces.shape[1])
+    locations, called = base_locations[keep], called[keep]
+    if not len(locations):
+        return TraceQC(0.0, nan, nan, float("nan"), 0)
+
+    # 只在峰值位置上求滑动窗口最小值作为基线
+    half = min(int(window), traces.shape[1])
+    padded = np.pad(traces.astype(np.float64), ((0, 0), (half, half)), mode="edge")
+    baseline = sliding_window_view(padded, 2 * half + 1, axis=1)[:, locations].min(axis=-1)
+    heights = np.clip(traces[:, locations] - baseline, 0, None)   # (4, 峰数)
+
+    peaks = np.arange(len(locations))
+    primary = heights[called, peaks]
+    is_called = np.zeros(heights.shape, dtype=bool)
+    is_called[called, peaks] = True
+    secondary = np.where(is_called, -np.inf, heights).max(axis=0)
+
+    n_called = is_called.sum(axis=1)
+    n_other = len(peaks) - n_called
+    with np.errstate(invalid="ignore", divide="ignore"):
+        signal = np.where(is_called, heights, 0).sum(axis=1) / n_called
+        noise = np.where(is_called, 0, heights).sum(axis=1) / n_other
+        # 噪音为 0 时按 1 个单位计，避免无穷大
+        channel_snr = signal / np.maximum(noise, 1.0)
+        ratio = secondary / primary
+    ratio = ratio[primary > 0]
+
+    valid = np.isfinite(channel_snr)
+    return TraceQC(
+        snr=float(np.median(channel_snr[valid])) if valid.any() else 0.0,
+        channel_snr=dict(zip(CHANNELS, channel_snr.tolist())),
+        noise=dict(zip(CHANNELS, noise.tolist())),
+        secondary_ratio=float(np.median(ratio)) if len(ratio) else float("nan"),
+        n_peaks=int(len(peaks)),
+    )
+
+
+def mottTrim(qualities, cutoff=DEFAULT_TRIM_CUTOFF):
+    """Mott 修剪：每个碱基记分 cutoff - 10^(-Q/10)，取累计得分最高的连续区间。
+    返回保留区间 (start, end)，没有合格碱基时为 (0, 0)"""
+    qualities = np.asarray(qualities, dtype=np.float64)
+    scores = cutoff - np.power(10.0, -qualities / 10)
+    # 前缀和减去此前的最小前缀和，最大处即最优区间的终点
+    prefix = np.concatenate(([0.0], np.cumsum(scores)))
+    lowest = np.minimum.accumulate(prefix)
+    end = int(np.argmax(prefix - lowest))
+    if prefix[end] - lowest[end] <= 0:
+        return 0, 0
+    start = int(np.argmin(prefix[:end + 1]))
+    return start, end
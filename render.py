@@ -0,0 +1,229 @@
+"""报告图片的绘制
+
+只用 matplotlib 面向对象的 Figure + Agg 画布，不经过 pyplot，也不修改全局 rcParams，
+因此可以在界面的后台线程或进程池的子进程里出图。
+每种图一个 Figure，创建一次后在各行报告之间复用，每次只更新数据和文字。
+Figure 不能被多个线程同时使用，defaultRenderer() 为每个线程各给一个 FigureRenderer。
+
+测序文件或位点很多时 (isLarge)，热图改用大矩阵模式 (heatMapPages)：整页一张栅格图，不画网格，
+只标注部分刻度；列数超过 MAX_COLUMNS 时相邻位点合并取平均，行按 PAGE_ROWS 分页，
+页数超过 MAX_PAGES 时相邻的测序文件也合并。因此出图时间不随矩阵变大而无限增长。
+"""
+import threading
+from io import BytesIO
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colorbar import make_axes
+from matplotlib.figure import Figure
+
+FIGSIZE = (15, 4)
+LARGE_FIGSIZE = (15, 6)
+DPI = 100
+# 定量热图中没有数据的格子
+MISSING_COLOR = "#f4cccc"
+
+# 超过这些行数/列数时热图改用大矩阵模式
+LARGE_ROWS = 40
+LARGE_COLUMNS = 80
+# 大矩阵模式每页的行数、最多页数和每页最多的列数
+PAGE_ROWS = 100
+MAX_PAGES = 10
+MAX_COLUMNS = 500
+# 大矩阵模式每个坐标轴最多标注的刻度数
+MAX_TICKS = 25
+
+
+def isLarge(shape):
+    """(测序文件数, 位点数) 是否需要用大矩阵模式"""
+    return shape[0] > LARGE_ROWS or shape[1] > LARGE_COLUMNS
+
+
+def binStarts(n, limit):
+    """把 n 个连续元素尽量平均地分成不超过 limit 组，返回每组的起点"""
+    return np.unique(np.linspace(0, n, min(n, limit) + 1)[:-1].astype(np.int64))
+
+
+def aggregate(data, row_starts, column_starts):
+    """按 binStarts 给出的分组对行、列求平均，nan 不计入；整组都是 nan 时为 nan"""
+    data = np.asarray(data, dtype=np.float64)
+    valid = ~np.isnan(data)
+    sums, counts = np.where(valid, data, 0.0), valid.astype(np.float64)
+    if len(row_starts) < data.shape[0]:
+        sums, counts = np.add.reduceat(sums, row_starts, axis=0), np.add.reduceat(counts, row_starts, axis=0)
+    if len(column_starts) < data.shape[1]:
+        sums, counts = np.add.reduceat(sums, column_starts, axis=1), np.add.reduceat(counts, column_starts, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def clusterRows(data, iterations=30):
+    """行的排列顺序，让甲基化模式相近的测序文件排在一起。
+    按各行在第一主成分上的投影排序 (幂迭代求主成分，nan 用该列平均值代替)，不依赖 scipy"""
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) < 3:
+        return np.arange(len(data))
+    valid = ~np.isnan(data)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(valid, data, 0).sum(axis=0) / valid.sum(axis=0)
+    centered = np.where(valid, data, np.nan_to_num(means)) - np.nan_to_num(means)
+    vector = np.random.default_rng(0).standard_normal(data.shape[1])
+    for _ in range(iterations):
+        vector = centered.T @ (centered @ vector)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return np.arange(len(data))
+        vector /= norm
+    # 投影相同时按平均甲基化水平排
+    return np.lexsort((centered.mean(axis=1), centered @ vector))
+
+
+def _tickIndex(n):
+    return np.unique(np.linspace(0, n - 1, min(n, MAX_TICKS)).round().astype(np.int64)) if n else np.empty(0, int)
+
+
+class FigureRenderer:
+    def __init__(self, figsize=FIGSIZE, dpi=DPI, large_figsize=LARGE_FIGSIZE):
+        self.figsize = figsize
+        self.large_figsize = large_figsize
+        self.dpi = dpi
+        self._figures = {}
+        self._binary = colormaps["binary"]
+        self._quant = colormaps["binary"].with_extremes(bad=MISSING_COLOR)
+
+    def _figure(self, kind):
+        """kind 对应的 Figure 及其坐标轴、图形元素，第一次用到时创建"""
+        if kind not in self._figures:
+            fig = Figure(figsize=self.large_figsize if kind == "large" else self.figsize, dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot()
+            parts = {"ax": ax}
+            if kind == "peak":
+                parts["line"], = ax.plot([], [], color="b")
+            elif kind == "large":
+                # 刻度标签每页不同，边距固定留出标题、坐标轴标签的位置
+                fig.subplots_adjust(left=0.1, right=0.98, bottom=0.1, top=0.93)
+                cax, _ = make_axes(ax)
+                parts["image"] = ax.imshow(np.zeros((1, 1)), cmap=self._quant, vmin=0, vmax=1, aspect="auto",
+                                           interpolation="nearest")
+                fig.colorbar(parts["image"], cax=cax)
+                parts["colorbar"] = cax
+            else:
+                # 热图的边距按空坐标轴收紧一次，之后不再重新计算。
+                # tight_layout 会留下一个占位的 layout engine，它让每次 savefig 多画一遍，去掉
+                fig.tight_layout()
+                fig.set_layout_engine(None)
+                if kind == "quant":
+                    cax, _ = make_axes(ax)
+                    parts["image"] = ax.imshow(np.zeros((1, 1)), cmap=self._quant, vmin=0, vmax=1)
+                    fig.colorbar(parts["image"], cax=cax)
+                    parts["colorbar"] = cax
+                else:
+                    parts["image"] = ax.imshow(np.zeros((1, 1)), cmap=self._binary)
+                ax.grid(which="minor", color="gray", linestyle='-', linewidth=2)
+            self._figures[kind] = (fig, parts)
+        return self._figures[kind]
+
+    def peakMap(self, values, title="", xlabel="Reference sequence", ylabel="Nums of methylation"):
+        """折线图，横坐标为参考序列位置。返回 Figure，下次画同类图时会被复用"""
+        fig, parts = self._figure("peak")
+        ax = parts["ax"]
+        values = np.asarray(values)
+        parts["line"].set_data(np.arange(len(values)), values)
+        ax.relim()
+        ax.autoscale_view()
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        return fig
+
+    def heatMap(self, data, columns=(), rows=(), title="", xlabel="CG positions", vmin=None, vmax=None,
+                colorbar_label=None):
+        """每格一个测序文件和位点的热图，columns/rows 为横纵坐标的标签。
+        colorbar_label 不为 None 时画颜色条，数据中的 nan 显示为 MISSING_COLOR。返回 Figure。
+        只替换图像数据和刻度，不清空坐标轴，已有的刻度对象会被复用"""
+        fig, parts = self._figure("heat" if colorbar_label is None else "quant")
+        ax, image = parts["ax"], parts["image"]
+
+        if colorbar_label is None:
+            image.set_data(data)
+        else:
+            image.set_data(np.ma.masked_invalid(data))
+            parts["colorbar"].set_ylabel(colorbar_label)
+        # 与 imshow 一致：没有给出范围时按数据的最小最大值
+        image.set_clim(vmin, vmax)
+        if vmin is None or vmax is None:
+            image.norm.vmin, image.norm.vmax = vmin, vmax
+            image.autoscale_None()
+        rows_count, columns_count = data.shape
+        image.set_extent((-.5, columns_count - .5, rows_count - .5, -.5))
+
+        ax.set_xticks(np.arange(columns_count + 1) - .5, minor=True)
+        ax.set_yticks(np.arange(rows_count + 1) - .5, minor=True)
+        ax.set_xticks(np.arange(len(columns)), labels=columns)
+        ax.set_yticks(np.arange(len(rows)), labels=rows)
+        ax.set_xlabel(xlabel)
+        ax.set_title(title)
+        return fig
+
+    def heatMapPages(self, data, columns=(), rows=(), title="", xlabel="CG positions", colorbar_label="Methylation",
+                     cluster=False, page_rows=PAGE_ROWS, max_pages=MAX_PAGES, max_columns=MAX_COLUMNS):
+        """大矩阵模式的热图，data 为 0-1 之间的值 (nan 为没有数据)。cluster 为 True 时先用 clusterRows 排序。
+        逐页产出 Figure，每页都是同一个对象，拿到后需要先保存再取下一页"""
+        data = np.asarray(data, dtype=np.float64)
+        rows, columns = [str(row) for row in rows], list(columns)
+        n_rows, n_columns = data.shape
+        if not n_rows or not n_columns:
+            return
+        if cluster:
+            order = clusterRows(data)
+            data, rows = data[order], [rows[i] for i in order]
+
+        row_starts = binStarts(n_rows, page_rows * max_pages)
+        column_starts = binStarts(n_columns, max_columns)
+        merged = aggregate(data, row_starts, column_starts)
+        column_labels = [columns[i] for i in column_starts]
+        # 合并的行标注为 "第一个 - 最后一个"
+        row_ends = np.append(row_starts[1:], n_rows) - 1
+        row_labels = [rows[start] if start == end else "%s - %s" % (rows[start], rows[end])
+                      for start, end in zip(row_starts, row_ends)]
+        if len(row_starts) < n_rows or len(column_starts) < n_columns:
+            title += " (%d x %d merged into %d x %d)" % (n_rows, n_columns, len(row_starts), len(column_starts))
+
+        pages = range(0, len(row_starts), page_rows)
+        for number, start in enumerate(pages, 1):
+            page_title = title if len(pages) == 1 else "%s, page %d/%d" % (title, number, len(pages))
+            yield self._largePage(merged[start:start + page_rows], column_labels,
+                                  row_labels[start:start + page_rows], page_title, xlabel, colorbar_label)
+
+    def _largePage(self, page, column_labels, row_labels, title, xlabel, colorbar_label):
+        fig, parts = self._figure("large")
+        ax, image = parts["ax"], parts["image"]
+        image.set_data(np.ma.masked_invalid(page))
+        image.set_extent((-.5, page.shape[1] - .5, page.shape[0] - .5, -.5))
+        parts["colorbar"].set_ylabel(colorbar_label)
+
+        x, y = _tickIndex(page.shape[1]), _tickIndex(page.shape[0])
+        ax.set_xticks(x, labels=[column_labels[i] for i in x])
+        ax.set_yticks(y, labels=[row_labels[i] for i in y])
+        ax.set_xlabel(xlabel)
+        ax.set_title(title)
+        return fig
+
+    @staticmethod
+    def png(fig):
+        buffer = BytesIO()
+        fig.savefig(buffer, format="png")
+        return buffer.getvalue()
+
+
+_local = threading.local()
+
+
+def defaultRenderer():
+    """当前线程的 FigureRenderer"""
+    renderer = getattr(_local, "renderer", None)
+    if renderer is None:
+        renderer = _local.renderer = FigureRenderer()
+    return renderer
@@ -0,0 +1,101 @@
+"""报告数据表的写出
+
+支持 xlsx、csv、parquet、feather 四种格式，parquet/feather 需要 pyarrow。
+写 xlsx 很慢 (openpyxl 逐格写)，默认只写 csv，需要时再用 exportExcel 或
+
+    python sheets.py Reports/Sheets/*.csv
+
+转成 xlsx (也可以在 sheet_formats 中明确要求 xlsx)。序列表在 xlsx 里保持原来的宽表 (每个碱基一列)，其它格式写成长表：
+每个测序文件的每个位置一行，列为 sample, position, reference, base, call。
+"""
+import importlib
+import os
+import sys
+
+import numpy as np
+
+# 格式 -> 扩展名
+FORMATS = {"xlsx": ".xlsx", "csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+DEFAULT_FORMATS = ("csv",)
+
+
+def checkFormats(formats):
+    """格式不认识或缺少依赖时抛出 ValueError，在开始分析前调用"""
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError("Unknown sheet format: %s (choose from %s)" % (fmt, ", ".join(FORMATS)))
+        if fmt in ("parquet", "feather"):
+            try:
+                importlib.import_module("pyarrow")
+            except ImportError:
+                raise ValueError("%s sheets need pyarrow (pip install pyarrow)" % fmt) from None
+
+
+def writeSheet(frame, path_base, fmt):
+    """把 DataFrame 写成 path_base + 扩展名，返回文件路径。行索引 (样品名) 一起写出"""
+    path = path_base + FORMATS[fmt]
+    if fmt == "xlsx":
+        frame.to_excel(path)
+    elif fmt == "csv":
+        frame.to_csv(path)
+    else:
+        # parquet/feather 要求列名是字符串，feather 不保存行索引，都把索引变成普通列
+        frame = frame.rename(columns=str)
+        frame = frame.rename_axis(frame.index.name or "sample").reset_index()
+        if fmt == "parquet":
+            frame.to_parquet(path, index=False)
+        else:
+            frame.to_feather(path)
+    return path
+
+
+def readSheet(path):
+    import pandas as pd
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return pd.read_csv(path, index_col=0)
+    if ext == ".parquet":
+        return pd.read_parquet(path).set_index("sample")
+    if ext == ".feather":
+        return pd.read_feather(path).set_index("sample")
+    if ext == ".xlsx":
+        return pd.read_excel(path, index_col=0)
+    raise ValueError("Unknown sheet format: " + path)
+
+
+def exportExcel(path):
+    """把已经写出的 csv/parquet/feather 表转成同名的 xlsx，返回 xlsx 路径"""
+    frame = readSheet(path)
+    return writeSheet(frame, os.path.splitext(path)[0], "xlsx")
+
+
+def tidySequences(names, matrix, ref_array, calls):
+    """序列表的长表。matrix 为 (测序文件数, 参考序列长度) 的碱基 (ASCII)，calls 为同形状的甲基化判断；
+    call 只在参考序列是 C 且测序结果覆盖的位置有值 (1 甲基化 / 0 未甲基化)，
+    其它位置以及没有覆盖的位置 (alignedRead 的 '-' 和补齐的 0，与 store.ResultStore.addReport 一致) 为空。
+    与其它表一样以样品名 (sample) 为行索引"""
+    import pandas as pd
+
+    n_reads, ref_length = matrix.shape
+
+    def letters(array):
+        # 碱基转成分类变量，补齐用的 0 显示为空字符串
+        values, codes = np.unique(array, return_inverse=True)
+        return pd.Categorical.from_codes(codes.ravel(), [chr(v) if v else "" for v in values])
+
+    is_c = np.broadcast_to(ref_array == ord("C"), matrix.shape).ravel()
+    covered = ((matrix != ord("-")) & (matrix != 0)).ravel()
+    return pd.DataFrame({
+        "sample": pd.Categorical.from_codes(np.repeat(np.arange(n_reads), ref_length), list(dict.fromkeys(names)))
+        if len(set(names)) == len(names) else np.repeat(np.asarray(names, dtype=object), ref_length),
+        "position": np.tile(np.arange(1, ref_length + 1, dtype=np.int32), n_reads),
+        "reference": letters(np.tile(ref_array, n_reads)),
+        "base": letters(matrix),
+        "call": pd.arrays.IntegerArray(np.asarray(calls, dtype=np.int8).ravel(), ~(is_c & covered)),
+    }).set_index("sample")
+
+
+if __name__ == "__main__":
+    for sheet in sys.argv[1:]:
+        print(exportExcel(sheet))
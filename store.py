@@ -0,0 +1,207 @@
+"""跨批次的甲基化结果库 (SQLite)
+
+每次分析把各行每个测序文件在每个 C 位点上的判断追加到同一个库里，按参考序列名 + 位置、样品、批次建索引，
+查询某个位点在所有批次中的结果不用再打开、合并各份报告的数据表：
+
+    python store.py amplicon_X 57
+
+表结构 (position 从 1 开始，与数据表的列名一致)：
+- runs: 每次分析 (BatchEngine.analyse) 一条 (id, label, started)
+- refs: 每个批次中每行的参考序列 (run, reference, sequence)
+- calls: (run, reference, position, sample, file, context, base, call, fraction)，context 为 CG/CHG/CHH，
+  base 为测序结果在该位置的碱基，call 为 0/1 (同 BSReport.calls)，fraction 为 C/(C+T) 峰高比例，没有时为空。
+  测序结果没有覆盖的位置不写入
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_STORE = os.path.join(os.path.expanduser("~"), ".bs_analyser", "results.sqlite")
+# 表结构变化时加一
+STORE_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    label TEXT,
+    started REAL
+);
+CREATE TABLE IF NOT EXISTS refs (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    reference TEXT NOT NULL,
+    sequence TEXT NOT NULL,
+    PRIMARY KEY (run, reference)
+);
+CREATE TABLE IF NOT EXISTS calls (
+    run INTEGER NOT NULL REFERENCES runs(id),
+    reference TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sample TEXT NOT NULL,
+    file TEXT,
+    context TEXT NOT NULL,
+    base TEXT NOT NULL,
+    call INTEGER NOT NULL,
+    fraction REAL
+);
+CREATE INDEX IF NOT EXISTS calls_site ON calls (reference, position, run);
+CREATE INDEX IF NOT EXISTS calls_sample ON calls (sample, reference);
+CREATE INDEX IF NOT EXISTS calls_run ON calls (run, reference);
+"""
+
+SiteCall = namedtuple("SiteCall", "run reference position sample file context base call fraction")
+# reads 为覆盖该位点的测序文件数，methylated 为其中判断为甲基化的数目，level = methylated / reads；
+# mean_fraction 为 C/(C+T) 比例的平均值 (没有比例时为 None)
+SiteLevel = namedtuple("SiteLevel", "run reference position context reads methylated level mean_fraction")
+
+
+def siteContexts(site_masks):
+    """每个 C 位点的类型 (CG/CHG/CHH)，参考序列末尾无法判断类型的 C 记为 C"""
+    contexts = np.full(len(site_masks["C"]), "C", dtype="<U3")
+    for context in ("CHH", "CHG", "CG"):
+        contexts[site_masks[context]] = context
+    return contexts[site_masks["C"]]
+
+
+class ResultStore:
+    def __init__(self, path=DEFAULT_STORE):
+        """打开 (不存在时创建) 结果库。连接可以交给其它线程使用，但同一时间只应有一个线程使用"""
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in (0, STORE_VERSION):
+            raise ValueError("%s was written by an incompatible version (%d)" % (path, version))
+        self._db.executescript(SCHEMA)
+        self._db.execute("PRAGMA user_version=%d" % STORE_VERSION)
+        # 本次写入的位点判断条数
+        self.inserted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def beginRun(self, label=None):
+        """新建一个批次，返回批次号"""
+        with self._db:
+            cursor = self._db.execute("INSERT INTO runs (label, started) VALUES (?, ?)", (label, time.time()))
+        return cursor.lastrowid
+
+    def addReport(self, run, row, report):
+        """写入一行 (AnalysisRow) 的 BSReport 中全部 C 位点的判断，返回写入条数。
+        同一批次里同名的参考序列会先删掉旧结果"""
+        loc = np.flatnonzero(report.site_masks["C"])
+        bases = report.matrix[:, loc]
+        # 没有覆盖的位置 (alignedRead 的 '-' 和补齐的 0) 不是未甲基化，跳过
+        reads, sites = np.nonzero((bases != ord("-")) & (bases != 0))
+        if report.fractions is None:
+            fractions = [None] * len(reads)
+        else:
+            fractions = report.fractions[:, loc][reads, sites]
+            fractions = np.where(np.isnan(fractions), None, fractions.astype(object)).tolist()
+
+        samples = [str(name) for name in row.sanger_names]
+        files = [str(f) for f in row.sanger_files]
+        contexts = siteContexts(report.site_masks)
+        records = [(run, row.name, position, samples[read], files[read], context, chr(base), call, fraction)
+                   for read, position, context, base, call, fraction in zip(
+                       reads.tolist(), (loc[sites] + 1).tolist(), contexts[sites].tolist(),
+                       bases[reads, sites].tolist(), report.calls[:, loc][reads, sites].astype(int).tolist(),
+                       fractions)]
+        with self._db:
+            self._db.execute("DELETE FROM calls WHERE run = ? AND reference = ?", (run, row.name))
+            self._db.execute("INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", (run, row.name, row.ref_sequence))
+            self.insertCalls(records)
+        return len(records)
+
+    def insertCalls(self, records):
+        """批量写入 (run, reference, position, sample, file, context, base, call, fraction) 记录。
+        不单独提交，在 with self._db 中调用时与其它语句一起提交"""
+        cursor = self._db.executemany("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+        self.inserted += cursor.rowcount
+        return cursor.rowcount
+
+    @staticmethod
+    def _where(**conditions):
+        """条件为 None 的列不限制；值为列表/元组时匹配其中任意一个"""
+        clauses, values = [], []
+        for column, value in conditions.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                clauses.append("%s IN (%s)" % (column, ", ".join("?" * len(value))))
+                values.extend(value)
+            else:
+                clauses.append(column + " = ?")
+                values.append(value)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", values
+
+    def query(self, reference=None, position=None, sample=None, run=None, context=None):
+        """单个测序文件的位点判断，返回 SiteCall 列表，按批次、位置、样品排序"""
+        where, values = self._where(reference=reference, position=position, sample=sample, run=run,
+                                    context=context)
+        cursor = self._db.execute("SELECT run, reference, position, sample, file, context, base, call, fraction "
+                                  "FROM calls" + where + " ORDER BY run, reference, position, sample", values)
+        return [SiteCall(*record) for record in cursor]
+
+    def levels(self, reference=None, position=None, sample=None, run=None, context=None):
+        """每个批次每个位点的甲基化水平，返回 SiteLevel 列表"""
+        where, values = self._where(reference=reference, position=position, sample=sample, run=run,
+                                    context=context)
+        cursor = self._db.execute(
+            "SELECT run, reference, position, context, COUNT(*), SUM(call), AVG(call), AVG(fraction) FROM calls"
+            + where + " GROUP BY run, reference, position ORDER BY run, reference, position", values)
+        return [SiteLevel(*record) for record in cursor]
+
+    def runs(self):
+        """[(批次号, label, 开始时间)]"""
+        return self._db.execute("SELECT id, label, started FROM runs ORDER BY id").fetchall()
+
+    def references(self, run=None):
+        """{参考序列名: 参考序列}，同名的以最近一个批次为准"""
+        where, values = self._where(run=run)
+        return dict(self._db.execute("SELECT reference, sequence FROM refs" + where + " ORDER BY run", values))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Methylation level of stored sites across runs")
+    parser.add_argument("reference", nargs="?", help="reference (row) name; omit to list runs")
+    parser.add_argument("position", nargs="*", type=int, help="1-based reference positions (default: all)")
+    parser.add_argument("--db", default=DEFAULT_STORE, help="result store (default: ~/.bs_analyser/results.sqlite)")
+    parser.add_argument("--samples", action="store_true", help="list every sample instead of per-run levels")
+    args = parser.parse_args(argv)
+
+    with ResultStore(args.db) as store:
+        if args.reference is None:
+            for run, label, started in store.runs():
+                print("%d\t%s\t%s" % (run, time.strftime("%Y-%m-%d %H:%M", time.localtime(started)), label or ""))
+        elif args.samples:
+            print("run\tposition\tcontext\tsample\tbase\tcall\tfraction")
+            for call in store.query(args.reference, args.position or None):
+                print("%d\t%d\t%s\t%s\t%s\t%d\t%s" % (
+                    call.run, call.position, call.context, call.sample, call.base, call.call,
+                    "" if call.fraction is None else "%.3f" % call.fraction))
+        else:
+            print("run\tposition\tcontext\treads\tmethylated\tlevel\tmean C/(C+T)")
+            for level in store.levels(args.reference, args.position or None):
+                print("%d\t%d\t%s\t%d\t%d\t%.3f\t%s" % (
+                    level.run, level.position, level.context, level.reads, level.methylated, level.level,
+                    "" if level.mean_fraction is None else "%.3f" % level.mean_fraction))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""新实现与旧实现结果一致：ABIFReader 对 Biopython、快速比对对 pairwise2、向量化甲基化计数对逐条循环
+
+    python -m pytest -q tests
+
+测序文件由 benchmarks/abifgen.py 临时生成，不需要真实数据。
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from abif import ABIFReader  # noqa: E402
+from abifgen import makeDataset  # noqa: E402
+from Analyser import BSReport, SangerBaseCall  # noqa: E402
+
+TAGS = ("PBAS1", "PBAS2", "PLOC1", "PLOC2", "PCON1", "PCON2", "DATA9", "DATA10", "DATA11", "DATA12", "SMPL1")
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    return makeDataset(str(tmp_path_factory.mktemp("traces")), reads=6, length=300, seed=1)
+
+
+def oldPeak(ref, seqs, locations):
+    """b4f5f18 中 BSReport.getmC / getmCG 的逐条循环"""
+    peak = {loc: 0 for loc in locations}
+    raw_data = []
+    for seq in seqs:
+        data = []
+        for loc in locations:
+            if seq[loc] == ref[loc]:
+                peak[loc] = peak[loc] + 1
+                data.append(1)
+            else:
+                data.append(0)
+        raw_data.append(data)
+    return peak, raw_data
+
+
+def testABIFReaderMatchesBiopython(dataset):
+    from Bio import SeqIO
+
+    _, files = dataset
+    for sanger_file in files:
+        abif_raw = SeqIO.read(sanger_file, "abi").annotations["abif_raw"]
+        with ABIFReader(sanger_file) as reader:
+            for tag in TAGS:
+                expected = abif_raw[tag]
+                value = reader[tag]
+                if isinstance(expected, (bytes, str)):
+                    expected = expected.encode("ascii") if isinstance(expected, str) else expected
+                    assert bytes(value) == expected, tag
+                else:
+                    assert list(value) == list(expected), tag
+
+
+def testSangerBaseCallReaders(dataset):
+    _, files = dataset
+    for sanger_file in files:
+        fast = SangerBaseCall(sanger_file, reader="abif")
+        slow = SangerBaseCall(sanger_file, reader="biopython")
+        assert fast.sanger_seq == slow.sanger_seq
+        for name in ("base_locations", "base_calls", "qualities", "traces"):
+            assert np.array_equal(getattr(fast, name), getattr(slow, name)), name
+
+
+@pytest.mark.filterwarnings("ignore::Bio.BiopythonDeprecationWarning")
+@pytest.mark.parametrize("aligner", ["fast", "seeded"])
+def testAlignerMatchesPairwise2(dataset, aligner):
+    ref, files = dataset
+    for sanger_file in files:
+        expected = SangerBaseCall(sanger_file, aligner="pairwise2", trim_cutoff=None).align(ref)
+        hit = SangerBaseCall(sanger_file, aligner=aligner, trim_cutoff=None).align(ref)
+        assert (hit.strand, hit.location_start, hit.location_end) == \
+               (expected.strand, expected.location_start, expected.location_end)
+        assert hit.alignedRead(len(ref)) == expected.alignedRead(len(ref))
+
+
+def testMethylationCallsMatchLoop(dataset):
+    ref, files = dataset
+    seqs = [SangerBaseCall(sanger_file).align(ref).alignedRead(len(ref)) for sanger_file in files]
+    report = BSReport([ref] + seqs)
+    for (peak, raw_data), locations in ((report.getmC(), report.C_loc), (report.getmCG(), report.CG_loc)):
+        expected_peak, expected_data = oldPeak(ref, seqs, locations)
+        assert peak == expected_peak
+        assert np.asarray(raw_data).tolist() == expected_data